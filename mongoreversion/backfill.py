@@ -0,0 +1,69 @@
+"""
+Creation of baseline revisions for documents that have none, e.g. after 
+turning on meta['versioned'] for an existing collection.
+"""
+from mongoengine import connection
+from mongoreversion.models import Revision
+
+def create_initial_revisions(document_class, user, batch_size=1000, start_after=None, end_before=None, comment=None):
+    """
+        Saves a revision of each document of the given class, within the 
+        optional (start_after, end_before) ID range, that has no revision yet.
+        Documents are read in ID order, batch_size at a time, and the 
+        revisions of a batch are written with a single insert. Yields 
+        (last document ID, created count) after each batch, the last document
+        ID resumes the backfill from there.
+    """
+    while True:
+        documents = document_class.objects.order_by('id')
+        if start_after is not None:
+            documents = documents.filter(id__gt=start_after)
+        if end_before is not None:
+            documents = documents.filter(id__lt=end_before)
+        documents = list(documents.limit(batch_size))
+        if not documents:
+            return
+
+        latest_ids = Revision.latest_revision_ids(documents)
+        missing = [document for document in documents if document.pk not in latest_ids]
+        if missing:
+            Revision.save_revisions(user, missing, comment)
+
+        start_after = documents[-1].pk
+        yield start_after, len(missing)
+
+def split_id_range(document_class, parts, start_after=None):
+    """
+        Returns a list of (start_after, end_before) ID ranges splitting the 
+        documents of the given class, after start_after, into roughly equal 
+        parts.
+    """
+    documents = document_class.objects.order_by('id')
+    if start_after is not None:
+        documents = documents.filter(id__gt=start_after)
+    count = documents.count()
+    boundaries = []
+    for i in range(1, parts):
+        document = documents.skip(count * i // parts).only('id').first()
+        if document is not None and (not boundaries or document.pk > boundaries[-1]):
+            boundaries.append(document.pk)
+    # ranges exclude end_before, so each boundary starts the next range
+    ranges = []
+    previous = start_after
+    for boundary in boundaries:
+        ranges.append((previous, boundary))
+        previous = _previous_id(document_class, boundary)
+    ranges.append((previous, None))
+    return ranges
+
+def _previous_id(document_class, document_id):
+    document = document_class.objects.filter(id__lt=document_id).order_by('-id').only('id').first()
+    return document.pk if document is not None else None
+
+def reset_connections():
+    """
+        Drops the mongo connections inherited from a parent process, so that 
+        forked workers open their own.
+    """
+    connection._connections.clear()
+    connection._dbs.clear()
@@ -0,0 +1,148 @@
+"""
+Background persistence of the revisions captured by ReversionedDocument.save,
+enabled with meta['revision_async'] = True.
+
+The backend is configured with the MONGOREVERSION_REVISION_BACKEND setting, the
+dotted path of a BaseRevisionBackend subclass (ThreadedBackend by default), and 
+MONGOREVERSION_REVISION_BACKEND_OPTIONS, a dict of keyword arguments for it.
+"""
+import atexit
+import logging
+import threading
+from datetime import datetime
+from importlib import import_module
+from django.conf import settings
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = 'mongoreversion.background.ThreadedBackend'
+
+class BaseRevisionBackend(object):
+    """
+        Persists the revisions of document snapshots submitted to it. The 
+        revisions are timestamped with the time of submission.
+    """
+
+    def submit(self, user, instance, comment=None):
+        raise NotImplementedError
+
+    def flush(self):
+        """
+            Blocks until all submitted revisions have been persisted.
+        """
+        pass
+
+    def shutdown(self):
+        self.flush()
+
+class SynchronousBackend(BaseRevisionBackend):
+    """
+        Persists revisions right away, in the calling thread.
+    """
+
+    def submit(self, user, instance, comment=None):
+        from mongoreversion.models import Revision
+        Revision.save_revision(user, instance, comment)
+
+class ThreadedBackend(BaseRevisionBackend):
+    """
+        Persists revisions from bounded queues with a pool of worker threads,
+        taking up to batch_size queued snapshots per Revision.save_revisions 
+        call. Each worker has its own queue, and the snapshots of a document 
+        always go to the same one, so that they are saved in the order they 
+        were submitted. Submitting blocks while the queue is full.
+    """
+    _stop = object()
+
+    def __init__(self, max_queue_size=1000, batch_size=100, workers=1):
+        self.queues = [queue.Queue(max_queue_size) for i in range(workers)]
+        self.batch_size = batch_size
+        self.threads = []
+        for i, worker_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._work, args=(worker_queue, ), name='mongoreversion-%s' % (i, ))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, user, instance, comment=None):
+        worker_queue = self.queues[hash(instance.pk) % len(self.queues)]
+        worker_queue.put((user, instance, comment, datetime.now()))
+
+    def flush(self):
+        for worker_queue in self.queues:
+            worker_queue.join()
+
+    def shutdown(self):
+        self.flush()
+        for worker_queue in self.queues:
+            worker_queue.put(self._stop)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def _work(self, worker_queue):
+        while True:
+            batch = [worker_queue.get()]
+            while batch[-1] is not self._stop and len(batch) < self.batch_size:
+                try:
+                    batch.append(worker_queue.get_nowait())
+                except queue.Empty:
+                    break
+            items = [item for item in batch if item is not self._stop]
+            try:
+                self._persist(items)
+            finally:
+                for item in batch:
+                    worker_queue.task_done()
+            if len(items) < len(batch):
+                return
+
+    def _persist(self, items):
+        from mongoreversion.models import Revision
+
+        # save consecutive snapshots by the same user with the same comment 
+        # together, keeping the order in which they were submitted
+        groups = []
+        for user, instance, comment, timestamp in items:
+            if groups and groups[-1][0].pk == user.pk and groups[-1][1] == comment:
+                groups[-1][2].append(instance)
+                groups[-1][3].append(timestamp)
+            else:
+                groups.append((user, comment, [instance], [timestamp]))
+        for user, comment, instances, timestamps in groups:
+            try:
+                Revision.save_revisions(user, instances, comment, timestamps)
+            except Exception:
+                logger.exception('failed to save %s revision(s) in the background', len(instances))
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """
+        Returns the configured revision backend, created on first use.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                path = getattr(settings, 'MONGOREVERSION_REVISION_BACKEND', DEFAULT_BACKEND)
+                options = getattr(settings, 'MONGOREVERSION_REVISION_BACKEND_OPTIONS', {})
+                module_name, class_name = path.rsplit('.', 1)
+                backend = getattr(import_module(module_name), class_name)(**options)
+                atexit.register(backend.shutdown)
+                _backend = backend
+    return _backend
+
+def flush():
+    """
+        Blocks until all revisions submitted so far have been persisted, for 
+        tests and shutdown hooks.
+    """
+    if _backend is not None:
+        _backend.flush()
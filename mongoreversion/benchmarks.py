@@ -0,0 +1,226 @@
+"""
+Benchmarks for the revisioning hot paths: save_revision with related 
+references, unchanged saves, materialization of nested revisions, and 
+latest_revision and history pagination on large histories.
+
+Each benchmark reports the wall time per call and, if the command counter of 
+mongoreversion.monitoring sees the client, the mongo commands issued and the 
+bytes written per call. They write large amounts of data to the revision 
+collection, run them against a scratch database only, see the 
+benchmark_revisions management command.
+"""
+import random
+import time
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from mongoengine.document import Document
+from mongoengine.fields import StringField, ReferenceField, ListField
+from mongoreversion.models import Revision, ContentType
+from mongoreversion.monitoring import command_counter
+
+class BenchmarkUser(Document):
+    username = StringField(max_length=255)
+
+class BenchmarkTag(Document):
+    title = StringField(max_length=100)
+
+    meta = {
+        'versioned': True, 
+    }
+
+class BenchmarkDocument(Document):
+    title = StringField(max_length=100)
+    tags = ListField(ReferenceField(BenchmarkTag, dbref=False))
+
+    meta = {
+        'versioned': True, 
+    }
+
+class BenchmarkNode(Document):
+    title = StringField(max_length=100)
+    parent = ReferenceField('self', dbref=False)
+
+    meta = {
+        'versioned': True, 
+    }
+
+BENCHMARK_DOCUMENT_CLASSES = (BenchmarkTag, BenchmarkDocument, BenchmarkNode, )
+
+def summarize(name, timings, commands=None, bytes_written=None):
+    """
+        Returns a dict of latency statistics in milliseconds for the given 
+        list of timings in seconds, with the mean number of commands and bytes
+        written per call if they were counted.
+    """
+    timings = sorted(timings)
+    return {
+        'name': name, 
+        'runs': len(timings), 
+        'mean_ms': 1000.0 * sum(timings) / len(timings), 
+        'median_ms': 1000.0 * timings[len(timings) // 2], 
+        'p95_ms': 1000.0 * timings[int(len(timings) * 0.95)], 
+        'max_ms': 1000.0 * timings[-1], 
+        'commands': float(sum(commands)) / len(commands) if commands else None, 
+        'bytes_written': float(sum(bytes_written)) / len(bytes_written) if bytes_written else None, 
+    }
+
+def measure(name, func, args_list):
+    """
+        Calls func once per args tuple and returns the summary of the calls.
+    """
+    timings = []
+    commands = []
+    bytes_written = []
+    for args in args_list:
+        before = command_counter.snapshot()
+        start = time.time()
+        func(*args)
+        timings.append(time.time() - start)
+        after = command_counter.snapshot()
+        commands.append(after['commands'] - before['commands'])
+        bytes_written.append(after['bytes_written'] - before['bytes_written'])
+    if not command_counter.registered:
+        commands = bytes_written = None
+    return summarize(name, timings, commands, bytes_written)
+
+def benchmark_user():
+    return BenchmarkUser(id=ObjectId(), username='benchmark')
+
+def cleanup():
+    """
+        Deletes the benchmark documents and their revisions.
+    """
+    for document_class in BENCHMARK_DOCUMENT_CLASSES:
+        instance_type = ContentType.get_for_class_name(document_class._class_name)
+        if instance_type is not None:
+            Revision.objects.filter(instance_type=instance_type).delete()
+        document_class.objects.delete()
+
+def seed_revisions(instance_type, instance_ids, revisions_per_instance, batch_size=10000):
+    """
+        Inserts revisions_per_instance revisions for each of the given 
+        instance IDs, in batches, bypassing save_revision.
+    """
+    collection = Revision._get_collection()
+    start = datetime.now() - timedelta(seconds=revisions_per_instance)
+    batch = []
+    for i in range(revisions_per_instance):
+        timestamp = start + timedelta(seconds=i)
+        for instance_id in instance_ids:
+            revision = Revision(user_id='benchmark', timestamp=timestamp, instance_type=instance_type, instance_data={'id': instance_id, 'title': 'Revision %s' % (i, )}, instance_id=instance_id)
+            batch.append(revision.to_mongo())
+            if len(batch) >= batch_size:
+                collection.insert_many(batch)
+                batch = []
+    if batch:
+        collection.insert_many(batch)
+
+def create_tagged_document(user, tag_count):
+    """
+        Saves a document referencing tag_count tags, all with a revision.
+    """
+    tags = [BenchmarkTag(title='Benchmark Tag %s' % (i, )) for i in range(tag_count)]
+    for tag in tags:
+        tag.save()
+    if tags:
+        Revision.save_revisions(user, tags)
+    doc = BenchmarkDocument(title='Benchmark Document', tags=tags)
+    doc.save()
+    return doc
+
+def bench_save_revision(related_count, runs=100):
+    """
+        Times save_revision of a changed document referencing related_count 
+        versioned documents.
+    """
+    user = benchmark_user()
+    doc = create_tagged_document(user, related_count)
+    Revision.save_revision(user, doc)
+    def save(i):
+        doc.title = 'Benchmark Document %s' % (i, )
+        Revision.save_revision(user, doc)
+    try:
+        return measure('save_revision (%s related)' % (related_count, ), save, [(i, ) for i in range(runs)])
+    finally:
+        cleanup()
+
+def bench_unchanged_save_revision(related_count=10, runs=100):
+    """
+        Times save_revision of a document that has not changed since its 
+        latest revision.
+    """
+    user = benchmark_user()
+    doc = create_tagged_document(user, related_count)
+    Revision.save_revision(user, doc)
+    try:
+        return measure('save_revision unchanged (%s related)' % (related_count, ), Revision.save_revision, [(user, doc) for i in range(runs)])
+    finally:
+        cleanup()
+
+def bench_materialize(depth, runs=100):
+    """
+        Times Revision.instance of a revision with a chain of depth nested 
+        related revisions.
+    """
+    user = benchmark_user()
+    parent = None
+    for i in range(depth + 1):
+        node = BenchmarkNode(title='Benchmark Node %s' % (i, ), parent=parent)
+        node.save()
+        revision, is_new = Revision.save_revision(user, node)
+        parent = node
+    def materialize():
+        return Revision.objects.get(pk=revision.pk).instance
+    try:
+        return measure('Revision.instance (depth %s)' % (depth, ), materialize, [() for i in range(runs)])
+    finally:
+        cleanup()
+
+def bench_latest_revision(history_size=1000000, instance_count=1000, runs=1000):
+    """
+        Times Revision.latest_revision over a revision collection holding 
+        history_size revisions spread over instance_count documents.
+    """
+    instance_type = ContentType.get_for_class_name(BenchmarkDocument._class_name, create=True)
+    instances = [BenchmarkDocument(id=ObjectId(), title='Benchmark %s' % (i, )) for i in range(instance_count)]
+    Revision.ensure_indexes()
+    seed_revisions(instance_type, [instance.pk for instance in instances], max(1, history_size // instance_count))
+    try:
+        args_list = [(random.choice(instances), ) for i in range(runs)]
+        return measure('latest_revision (%s revisions)' % (history_size, ), Revision.latest_revision, args_list)
+    finally:
+        cleanup()
+
+def bench_history(history_size=100000, page_size=100):
+    """
+        Times every page of Revision.history through a document with 
+        history_size revisions, the last pages cost as much as the first.
+    """
+    instance_type = ContentType.get_for_class_name(BenchmarkDocument._class_name, create=True)
+    instance = BenchmarkDocument(id=ObjectId(), title='Benchmark')
+    Revision.ensure_indexes()
+    seed_revisions(instance_type, [instance.pk], history_size)
+    cursors = [None]
+    def page():
+        revisions, cursor = Revision.history(instance, page_size, cursors[-1])
+        cursors.append(cursor)
+    try:
+        return measure('history (%s revisions, %s per page)' % (history_size, page_size, ), page, [() for i in range(max(1, history_size // page_size))])
+    finally:
+        cleanup()
+
+def run_all(history_size=1000000, instance_count=1000, runs=100):
+    """
+        Runs all benchmarks, returning their summaries.
+    """
+    return [
+        bench_save_revision(0, runs), 
+        bench_save_revision(10, runs), 
+        bench_save_revision(1000, runs), 
+        bench_unchanged_save_revision(10, runs), 
+        bench_materialize(1, runs), 
+        bench_materialize(5, runs), 
+        bench_materialize(20, runs), 
+        bench_latest_revision(history_size, instance_count, runs), 
+        bench_history(min(history_size, 100000)), 
+    ]
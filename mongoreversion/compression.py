@@ -0,0 +1,75 @@
+"""
+Compression of revision payloads, enabled per document class with 
+meta['revision_compression'] = 'zlib', 'zstd' or True (the best available).
+zstd needs the zstandard package, zlib is used when it is missing.
+"""
+import zlib
+from bson import BSON
+from bson.binary import Binary
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_ZSTD = 'zstd'
+
+def compression_method(document_class):
+    """
+        Returns the compression method of the revisions of the given document 
+        class, or None if they are not compressed.
+    """
+    method = document_class._meta.get('revision_compression', None)
+    if not method:
+        return None
+    if method is True or method == COMPRESSION_ZSTD:
+        return COMPRESSION_ZSTD if zstandard is not None else COMPRESSION_ZLIB
+    if method != COMPRESSION_ZLIB:
+        raise ImproperlyConfigured('unknown revision_compression %r of %s' % (method, document_class._class_name, ))
+    return method
+
+def compress(data, method):
+    """
+        Returns the given mongo-ready dict as a compressed BSON blob.
+    """
+    encoded = BSON.encode({'data': data})
+    if method == COMPRESSION_ZSTD:
+        return Binary(zstandard.ZstdCompressor().compress(encoded))
+    return Binary(zlib.compress(encoded))
+
+def decompress(blob, method):
+    if method == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ImproperlyConfigured('the zstandard package is needed to read zstd compressed revisions')
+        encoded = zstandard.ZstdDecompressor().decompress(blob)
+    else:
+        encoded = zlib.decompress(blob)
+    return BSON(encoded).decode()['data']
+
+def compress_existing_revisions(document_class, method=None, batch_size=1000, start_after=None):
+    """
+        Compresses the stored revisions of the given document class that are 
+        not compressed yet, batch_size at a time in ID order, with one bulk 
+        write per batch. Yields (last revision ID, compressed count) after each
+        batch, the last revision ID resumes from there.
+    """
+    from pymongo import UpdateOne
+    from mongoreversion.models import Revision, ContentType
+
+    method = method or compression_method(document_class) or COMPRESSION_ZLIB
+    instance_type = ContentType.get_for_class_name(document_class._class_name)
+    if instance_type is None:
+        return
+    collection = Revision._get_collection()
+    while True:
+        query = {'instance_type': instance_type.pk, 'compression': None}
+        if start_after is not None:
+            query['_id'] = {'$gt': start_after}
+        sons = list(collection.find(query, {'instance_data': 1}).sort('_id', 1).limit(batch_size))
+        if not sons:
+            return
+        collection.bulk_write([UpdateOne({'_id': son['_id']}, {'$set': {'instance_data': {}, 'instance_data_compressed': compress(son.get('instance_data', {}), method), 'compression': method}}) for son in sons], ordered=False)
+        start_after = sons[-1]['_id']
+        yield start_after, len(sons)
@@ -0,0 +1,35 @@
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from mongoengine import connection
+from mongoreversion import benchmarks
+from mongoreversion.monitoring import command_counter
+
+class Command(NoArgsCommand):
+    help = 'Runs the revisioning benchmarks, against a scratch database only.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--history-size', dest='history_size', type='int', default=1000000, 
+            help='Number of revisions in the collection for latest_revision.'), 
+        make_option('--instances', dest='instance_count', type='int', default=1000, 
+            help='Number of documents the revisions are spread over.'), 
+        make_option('--runs', dest='runs', type='int', default=100, 
+            help='Number of timed calls per benchmark.'), 
+        make_option('--host', dest='host', default=None, 
+            help='Connect to this mongodb:// (or mongomock://) URI instead of the configured database, counting the commands issued.'), 
+    )
+
+    def handle_noargs(self, **options):
+        if options['host']:
+            connection.disconnect()
+            if options['host'].startswith('mongomock://'):
+                connection.connect(host=options['host'])
+            else:
+                connection.connect(host=options['host'], event_listeners=[command_counter])
+                command_counter.registered = True
+
+        results = benchmarks.run_all(options['history_size'], options['instance_count'], options['runs'])
+        for result in results:
+            line = '%(name)s: runs=%(runs)d mean=%(mean_ms).3fms median=%(median_ms).3fms p95=%(p95_ms).3fms max=%(max_ms).3fms' % result
+            if result['commands'] is not None:
+                line += ' commands=%(commands).1f bytes_written=%(bytes_written).0f' % result
+            self.stdout.write(line + '\n')
@@ -0,0 +1,44 @@
+from optparse import make_option
+from bson.objectid import ObjectId
+from django.core.management.base import BaseCommand, CommandError
+from mongoengine.base import _document_registry
+from mongoreversion import compression
+
+class Command(BaseCommand):
+    args = '[document class name ...]'
+    help = 'Compresses the stored revisions of each document class declaring meta["revision_compression"], or of the given ones.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--method', dest='method', default=None, 
+            help='zlib or zstd, defaults to the method configured for the class.'), 
+        make_option('--batch-size', dest='batch_size', type='int', default=1000, 
+            help='Number of revisions compressed per batch.'), 
+        make_option('--start-after', dest='start_after', default=None, 
+            help='Resume after this revision ID, as printed by a previous run.'), 
+    )
+
+    def handle(self, *args, **options):
+        if options['method'] not in (None, compression.COMPRESSION_ZLIB, compression.COMPRESSION_ZSTD):
+            raise CommandError('unknown compression method: %s' % (options['method'], ))
+        if options['method'] == compression.COMPRESSION_ZSTD and compression.zstandard is None:
+            raise CommandError('the zstandard package is needed for zstd compression')
+        if args:
+            document_classes = []
+            for class_name in args:
+                document_class = _document_registry.get(class_name, None)
+                if document_class is None:
+                    raise CommandError('unknown document class: %s' % (class_name, ))
+                document_classes.append(document_class)
+        else:
+            document_classes = [document_class for class_name, document_class in sorted(_document_registry.items()) if compression.compression_method(document_class)]
+        if options['start_after'] and len(document_classes) != 1:
+            raise CommandError('--start-after requires a single document class')
+        start_after = ObjectId(options['start_after']) if options['start_after'] else None
+
+        for document_class in document_classes:
+            compressed = 0
+            for last_id, count in compression.compress_existing_revisions(document_class, options['method'], options['batch_size'], start_after):
+                compressed += count
+                if int(options.get('verbosity', 1)) > 1:
+                    self.stdout.write('%s: %s revisions up to %s, resume with --start-after=%s\n' % (document_class._class_name, count, last_id, last_id, ))
+            self.stdout.write('%s: compressed %s revisions\n' % (document_class._class_name, compressed, ))
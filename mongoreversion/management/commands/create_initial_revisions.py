@@ -0,0 +1,76 @@
+from multiprocessing import Pool
+from optparse import make_option
+from bson.objectid import ObjectId
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from mongoengine.base import _document_registry
+from mongoreversion import backfill
+
+def _backfill_range(args):
+    class_name, user_pk, batch_size, start_after, end_before, comment = args
+    user = User.objects.get(pk=user_pk)
+    created = 0
+    for last_id, count in backfill.create_initial_revisions(_document_registry[class_name], user, batch_size, start_after, end_before, comment):
+        created += count
+    return created
+
+class Command(BaseCommand):
+    args = '<document class name ...>'
+    help = 'Creates a baseline revision for each document of the given classes that has none. Give the classes of related documents first so that their revisions are referenced.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--username', dest='username', 
+            help='Username of the Django user the revisions are attributed to.'), 
+        make_option('--comment', dest='comment', default='Initial revision', 
+            help='Comment of the created revisions.'), 
+        make_option('--batch-size', dest='batch_size', type='int', default=1000, 
+            help='Number of documents read and revisions inserted per batch.'), 
+        make_option('--start-after', dest='start_after', default=None, 
+            help='Resume after this document ID, as printed by a previous run.'), 
+        make_option('--workers', dest='workers', type='int', default=1, 
+            help='Number of worker processes, each backfilling a range of document IDs.'), 
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('give at least one document class name')
+        if not options['username']:
+            raise CommandError('--username is required')
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist:
+            raise CommandError('unknown user: %s' % (options['username'], ))
+        document_classes = []
+        for class_name in args:
+            document_class = _document_registry.get(class_name, None)
+            if document_class is None:
+                raise CommandError('unknown document class: %s' % (class_name, ))
+            if not document_class._meta.get('versioned', None):
+                raise CommandError('%s is not versioned, set versioned=True to enable' % (class_name, ))
+            document_classes.append(document_class)
+        if options['start_after'] and len(document_classes) != 1:
+            raise CommandError('--start-after requires a single document class')
+        start_after = ObjectId(options['start_after']) if options['start_after'] else None
+
+        for document_class in document_classes:
+            if options['workers'] > 1:
+                created = self.backfill_parallel(document_class, user, start_after, options)
+            else:
+                created = 0
+                for last_id, count in backfill.create_initial_revisions(document_class, user, options['batch_size'], start_after, comment=options['comment']):
+                    created += count
+                    if int(options.get('verbosity', 1)) > 1:
+                        self.stdout.write('%s: %s revisions up to %s, resume with --start-after=%s\n' % (document_class._class_name, count, last_id, last_id, ))
+            self.stdout.write('%s: created %s revisions\n' % (document_class._class_name, created, ))
+
+    def backfill_parallel(self, document_class, user, start_after, options):
+        ranges = backfill.split_id_range(document_class, options['workers'], start_after)
+        # workers must not share the parent's database connections
+        connection.close()
+        pool = Pool(options['workers'], backfill.reset_connections)
+        try:
+            return sum(pool.map(_backfill_range, [(document_class._class_name, user.pk, options['batch_size'], range_start, range_end, options['comment']) for range_start, range_end in ranges]))
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+from mongoreversion.models import Revision, ContentType
+
+class Command(NoArgsCommand):
+    help = 'Builds the indexes declared on the revision and content type collections.'
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for document_class in (ContentType, Revision, ):
+            document_class.ensure_indexes()
+            if verbosity > 0:
+                collection = document_class._get_collection()
+                self.stdout.write('%s: %s\n' % (collection.name, ', '.join(sorted(collection.index_information().keys())), ))
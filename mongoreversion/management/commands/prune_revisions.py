@@ -0,0 +1,52 @@
+from optparse import make_option
+from bson.objectid import ObjectId
+from django.core.management.base import BaseCommand, CommandError
+from mongoengine.base import _document_registry
+from mongoreversion import retention
+
+class Command(BaseCommand):
+    args = '[document class name ...]'
+    help = 'Deletes revisions according to the meta["revision_retention"] policy of each document class, or of the given ones.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=100, 
+            help='Number of documents whose revisions are pruned per batch.'), 
+        make_option('--max-batches', dest='max_batches', type='int', default=None, 
+            help='Stop after this many batches per document class.'), 
+        make_option('--start-after', dest='start_after', default=None, 
+            help='Resume after this instance ID, as printed by a previous run.'), 
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False, 
+            help='Report what would be deleted without deleting anything.'), 
+        make_option('--index-references', action='store_true', dest='index_references', default=False, 
+            help='First index the related revisions of revisions saved by older versions.'), 
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            document_classes = []
+            for class_name in args:
+                document_class = _document_registry.get(class_name, None)
+                if document_class is None:
+                    raise CommandError('unknown document class: %s' % (class_name, ))
+                if not retention.retention_policy(document_class):
+                    raise CommandError('%s does not declare meta["revision_retention"]' % (class_name, ))
+                document_classes.append(document_class)
+        else:
+            document_classes = retention.retained_document_classes()
+
+        if options['index_references']:
+            self.stdout.write('indexed related revisions of %s revisions\n' % (retention.index_related_revisions(), ))
+
+        if options['start_after'] and len(document_classes) != 1:
+            raise CommandError('--start-after requires a single document class')
+        start_after = ObjectId(options['start_after']) if options['start_after'] else None
+        for document_class in document_classes:
+            deleted = 0
+            for i, (last_instance_id, count) in enumerate(retention.prune_revisions(document_class, options['batch_size'], start_after, dry_run=options['dry_run'])):
+                deleted += count
+                if int(options.get('verbosity', 1)) > 1:
+                    self.stdout.write('%s: %s revisions up to instance %s\n' % (document_class._class_name, count, last_instance_id, ))
+                if options['max_batches'] and i + 1 >= options['max_batches']:
+                    self.stdout.write('%s: stopped, resume with --start-after=%s\n' % (document_class._class_name, last_instance_id, ))
+                    break
+            self.stdout.write('%s: %s %s revisions\n' % (document_class._class_name, 'would delete' if options['dry_run'] else 'deleted', deleted, ))
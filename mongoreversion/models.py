@@ -1,10 +1,53 @@
 from django.db import models
 from mongoengine.document import Document
-from mongoengine.fields import DictField, StringField, ReferenceField, IntField, DateTimeField, ListField, ObjectIdField
+from mongoengine.fields import DictField, StringField, ReferenceField, IntField, DateTimeField, ListField, ObjectIdField, BinaryField, EmbeddedDocumentField, GenericEmbeddedDocumentField, GenericReferenceField
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.conf import settings
+from django.core.cache import cache
 from django.contrib.contenttypes.models import ContentType as DjangoContentType
 from datetime import datetime
-from mongoengine.base import _document_registry
+import hashlib
+import json
+import time
+from importlib import import_module
+from mongoengine.base import _document_registry, BaseDocument, BaseField
+from mongoengine.queryset import Q
+from bson.objectid import ObjectId
+from bson.son import SON
+from pymongo import InsertOne, UpdateOne
+from mongoreversion import background, compression
+from mongoreversion.monitoring import command_counter
+
+try:
+    from django.contrib.auth import get_user_model
+except ImportError:
+    # Django < 1.5 has no configurable user model
+    def get_user_model():
+        return User
+
+# storage modes of revision instance data, set with meta['revision_storage']
+REVISION_STORAGE_FULL = 'full'
+REVISION_STORAGE_DELTA = 'delta'
+
+# default number of revisions between full snapshots in delta storage mode, 
+# set with meta['revision_keyframe_interval']
+DEFAULT_KEYFRAME_INTERVAL = 10
+
+# fields left out when listing revision histories, see Revision.history
+REVISION_PAYLOAD_FIELDS = ('instance_data', 'instance_data_compressed', 'instance_related_revisions', 'unset_fields', 'related_revision_ids', 'field_hashes', )
+
+# fields of the latest revisions loaded by save_revisions to check for 
+# changes, the field hashes and payload are only loaded where needed
+LATEST_REVISION_FIELDS = ('id', 'user_id', 'timestamp', 'instance_type', 'instance_id', 'comment', 'content_hash', 'base_revision', 'delta_depth', 'compression', )
+
+# format of the timestamp part of history cursors
+CURSOR_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# separates the segments of the paths to values nested in dicts, embedded 
+# documents and lists, e.g. 'address__city' or 'items__0__owner', as in 
+# mongoengine query keywords
+PATH_SEPARATOR = '__'
 
 class ReversionedDocument(Document):
     """
@@ -23,23 +66,437 @@ class ReversionedDocument(Document):
     def revisions_count(self):        
         return self.revisions.count()
 
+    def history(self, limit=20, cursor=None, fields=None):
+        return Revision.history(self, limit, cursor, fields)
+
+    def as_of(self, timestamp):
+        """
+            Returns an unsaved instance of the document as it was at the given 
+            time, or None if it had no revision yet.
+        """
+        return self.__class__.as_of_many([self.pk], timestamp).get(self.pk)
+
+    @classmethod
+    def as_of_many(cls, ids, timestamp):
+        """
+            Returns a dict mapping document ID -> unsaved instance of the 
+            document as it was at the given time, related documents included.
+            Documents without a revision at that time are left out.
+        """
+        revision_ids = Revision.revision_ids_as_of(cls._class_name, ids, timestamp)
+        if not revision_ids:
+            return {}
+        revisions = Revision.objects.in_bulk(list(revision_ids.values()))
+        instances = Revision.materialize(revisions.values(), as_of=timestamp)
+        return dict((instance.pk, instance) for instance in instances)
+
+    def iter_history(self, page_size=100, fields=None):
+        return Revision.iter_history(self, page_size, fields)
+
+    def history_count(self, cached=False, max_count=None):
+        return Revision.history_count(self, cached, max_count)
+
     @property
     def revisions(self):
-        instance_type = ContentType.objects.get(class_name=self._class_name)
-        return Revision.objects.filter(instance_type=instance_type, instance_id=self.pk).order_by('-timestamp')
+        instance_type = ContentType.get_for_class_name(self._class_name)
+        if instance_type is None:
+            return Revision.objects.none()
+        return Revision.objects.filter(instance_type=instance_type, instance_id=self.pk).order_by('-timestamp', '-id')
 
     def save_revision(self, user, comment=''):
         return Revision.save_revision(user, self, comment)
 
+    def snapshot(self):
+        """
+            Returns a detached copy of the document as it is now, for capturing
+            its revision later on.
+        """
+        return self.__class__._from_son(self.to_mongo())
+
     def save(self, *args, **kwargs):
         user = kwargs.pop('user', None)
+        comment = kwargs.pop('revision_comment', '')
         r = super(ReversionedDocument, self).save(*args, **kwargs)
         if self._meta.get('create_revision_after_save', False):
             if not user:
                 raise ValueError('user must be passed to instance save when create_revision_after_save=True')
-            self.save_revision(user, kwargs.get('revision_comment', ''))
+            if self._meta.get('revision_async', False):
+                # persist the revision in the background, see background.py
+                background.get_backend().submit(user, self.snapshot(), comment)
+            else:
+                self.save_revision(user, comment)
         return r
 
+def versioned_field_names(document_class):
+    """
+        Returns the set of field names captured by revisions of the given 
+        document class, declared with meta['versioned_fields'] and 
+        meta['versioned_related'], or None if all fields are captured.
+    """
+    meta = document_class._meta
+    if 'versioned_fields' not in meta and 'versioned_related' not in meta:
+        return None
+    return set(meta.get('versioned_fields') or []) | set(meta.get('versioned_related') or [])
+
+# lookup of document class name -> (document class, related field types, 
+# structured fields), see related_field_types and structured_fields
+_related_field_types_cache = {}
+
+def related_field_types(document_class):
+    """
+        Returns a dict of field name -> related document class for the 
+        reference fields of the given document class. The field schema is 
+        introspected once per class, and again if the class registered under 
+        its name is replaced.
+    """
+    cached = _related_field_types_cache.get(document_class._class_name)
+    if cached is not None and cached[0] is document_class:
+        return cached[1]
+
+    # create lookup of related field types and structured fields
+    field_types = {}
+    structured = {}
+    for key, field in document_class._fields.items():
+        related_field_type = None
+        if isinstance(field, ListField) and isinstance(field.field, ReferenceField):
+            related_field_type = field.field.document_type_obj
+        elif isinstance(field, ReferenceField):
+            related_field_type = field.document_type_obj
+        elif _is_structured(field):
+            structured[key] = field
+
+        if related_field_type:
+            field_types[key] = related_field_type
+    _related_field_types_cache[document_class._class_name] = (document_class, field_types, structured)
+    return field_types
+
+def structured_fields(document_class):
+    """
+        Returns a dict of field name -> field for the fields of the given 
+        document class that hold nested values, see _is_structured.
+    """
+    related_field_types(document_class)
+    return _related_field_types_cache[document_class._class_name][2]
+
+def clear_related_field_types_cache():
+    _related_field_types_cache.clear()
+
+def _is_structured(field):
+    """
+        Returns whether the given field holds nested values: dicts, embedded 
+        documents, generic references, or lists of them or of other lists.
+    """
+    if isinstance(field, (DictField, EmbeddedDocumentField, GenericEmbeddedDocumentField, GenericReferenceField)):
+        return True
+    return isinstance(field, ListField) and (isinstance(field.field, ListField) or _is_structured(field.field))
+
+def _child_path(path, key):
+    # returns None where the path could not be split back into its keys: for
+    # keys containing the separator, and below keys ending with '_'
+    key = str(key)
+    if PATH_SEPARATOR in key:
+        return None
+    if path is None:
+        return key
+    if path.endswith('_'):
+        return None
+    return path + PATH_SEPARATOR + key
+
+def _capture_value(field, value):
+    """
+        Returns the given value of a structured field in its mongo form, with
+        the references within replaced by object IDs.
+    """
+    if value is None:
+        return None
+    if isinstance(field, ReferenceField):
+        return value.pk if isinstance(value, Document) else getattr(value, 'id', value)
+    if isinstance(field, GenericReferenceField):
+        # {'_cls': class name, '_ref': DBRef}, as mongoengine stores it
+        return field.to_mongo(value)
+    if isinstance(field, (EmbeddedDocumentField, GenericEmbeddedDocumentField)) and isinstance(value, BaseDocument):
+        # the field adds _cls where the document class is needed to load it
+        son = field.to_mongo(value)
+        for name, subfield in value._fields.items():
+            if subfield.db_field in son:
+                son[subfield.db_field] = _capture_value(subfield, value._data.get(name))
+        return son
+    if isinstance(field, ListField) and field.field is not None:
+        return [_capture_value(field.field, item) for item in value]
+    if isinstance(field, DictField) and field.field is not None:
+        return dict((key, _capture_value(field.field, item)) for key, item in value.items())
+    return field.to_mongo(value)
+
+def _nested_references(field, value, path, references=None):
+    """
+        Returns a list of (path, document class, object ID) for the 
+        references within the given captured value of a structured field. 
+        References in untyped dicts and lists are left out.
+    """
+    if references is None:
+        references = []
+    if value is None or path is None:
+        return references
+    if isinstance(field, ReferenceField):
+        references.append((path, field.document_type, getattr(value, 'id', value)))
+    elif isinstance(field, GenericReferenceField):
+        document_type = _document_registry.get(value.get('_cls')) if isinstance(value, dict) else None
+        if document_type is not None and value.get('_ref') is not None:
+            references.append((path, document_type, getattr(value['_ref'], 'id', value['_ref'])))
+    elif isinstance(field, (EmbeddedDocumentField, GenericEmbeddedDocumentField)):
+        if '_cls' in value:
+            document_type = _document_registry.get(value['_cls'])
+        else:
+            document_type = getattr(field, 'document_type', None)
+        for subfield in (document_type._fields.values() if document_type else []):
+            if subfield.db_field in value:
+                _nested_references(subfield, value[subfield.db_field], _child_path(path, subfield.db_field), references)
+    elif isinstance(field, ListField) and field.field is not None:
+        for index, item in enumerate(value):
+            _nested_references(field.field, item, _child_path(path, index), references)
+    elif isinstance(field, DictField) and field.field is not None:
+        for key, item in value.items():
+            _nested_references(field.field, item, _child_path(path, key), references)
+    return references
+
+def structural_diff(old, new, path=None):
+    """
+        Returns (changes, removed) between two values of revision data: a 
+        dict of path -> new value of what was added or changed, and a list 
+        of the paths that were removed. Dicts are compared key by key and 
+        lists of the same length item by item, anything else as a whole.
+    """
+    changes = {}
+    removed = []
+    if isinstance(old, dict) and isinstance(new, dict) and None not in [_child_path(path, key) for key in set(old) | set(new)]:
+        for key, value in new.items():
+            if key not in old:
+                changes[_child_path(path, key)] = value
+            elif old[key] != value:
+                child_changes, child_removed = structural_diff(old[key], value, _child_path(path, key))
+                changes.update(child_changes)
+                removed.extend(child_removed)
+        removed.extend(_child_path(path, key) for key in old if key not in new)
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new) and path is not None:
+        for index, (old_value, value) in enumerate(zip(old, new)):
+            if old_value != value:
+                child_changes, child_removed = structural_diff(old_value, value, _child_path(path, index))
+                changes.update(child_changes)
+                removed.extend(child_removed)
+    elif old != new:
+        changes[path] = new
+    return changes, removed
+
+def _copy_value(value):
+    # copies the nested dicts and lists of revision data into plain ones
+    if isinstance(value, dict):
+        return dict((key, _copy_value(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_copy_value(item) for item in value]
+    return value
+
+def _set_path(data, path, value=None, unset=False):
+    """
+        Sets, or unsets, the value at the given path of the given revision 
+        data. The nested containers along the path are copied rather than 
+        changed in place, as they may be shared with other revisions.
+    """
+    segments = path.split(PATH_SEPARATOR)
+    container = data
+    for segment in segments[:-1]:
+        key = int(segment) if isinstance(container, list) else segment
+        child = container[key]
+        container[key] = list(child) if isinstance(child, list) else dict(child)
+        container = container[key]
+    key = int(segments[-1]) if isinstance(container, list) else segments[-1]
+    if not unset:
+        container[key] = value
+    elif isinstance(container, dict):
+        container.pop(key, None)
+
+def _assign_path(instance, path, value):
+    """
+        Sets the value at the given path of a structured field of the given 
+        document instance, without dereferencing anything along the path.
+    """
+    segments = path.split(PATH_SEPARATOR)
+    container = instance
+    for segment in segments:
+        if isinstance(container, BaseDocument):
+            key = container._reverse_db_field_map.get(segment, segment) if container is not instance else segment
+            parent, container = container._data, container._data.get(key)
+        elif isinstance(container, list):
+            key = int(segment)
+            parent, container = container, container[key]
+        else:
+            key = segment
+            parent, container = container, container[key]
+    parent[key] = value
+
+def _as_document(document_type, value):
+    """
+        Returns an unsaved document holding only the ID for the given unloaded 
+        reference (DBRef or object ID), or the value itself if it is a document.
+    """
+    if value is None or isinstance(value, Document):
+        return value
+    return document_type(id=getattr(value, 'id', value))
+
+def _aggregate(document_class, pipeline):
+    """
+        Runs an aggregation pipeline against the collection of the given 
+        document class and returns the list of result documents.
+    """
+    results = document_class._get_collection().aggregate(pipeline)
+    # older pymongo versions return the raw command response
+    if isinstance(results, dict):
+        return results.get('result', [])
+    return list(results)
+
+# marks a Revision whose user has not been loaded yet
+_unresolved = object()
+
+def load_users(user_ids):
+    """
+        The default user loader, returns a dict mapping user ID -> user for the
+        given revision user IDs. Object IDs are looked up as documents of the 
+        class registered under the name given by the MONGOREVERSION_USER_DOCUMENT
+        setting if any, other IDs as users of the Django user model, one query
+        per backend.
+    """
+    users = {}
+    document_class_name = getattr(settings, 'MONGOREVERSION_USER_DOCUMENT', None)
+    user_model = get_user_model()
+    django_ids = []
+    for user_id in user_ids:
+        if document_class_name and ObjectId.is_valid(user_id):
+            continue
+        try:
+            django_ids.append(user_model._meta.pk.to_python(user_id))
+        except ValidationError:
+            pass
+    if django_ids:
+        for pk, user in user_model.objects.in_bulk(django_ids).items():
+            users[str(pk)] = user
+    if document_class_name:
+        document_class = _document_registry[document_class_name]
+        document_ids = [ObjectId(user_id) for user_id in user_ids if ObjectId.is_valid(user_id)]
+        if document_ids:
+            for pk, user in document_class.objects.in_bulk(document_ids).items():
+                users[str(pk)] = user
+    return users
+
+# lookup of dotted path -> imported user loader, see get_user_loader
+_user_loaders = {}
+
+def get_user_loader():
+    """
+        Returns the user loader named by the MONGOREVERSION_USER_LOADER setting,
+        a dotted path to a function with the signature of load_users, or 
+        load_users itself. The setting is read on each call.
+    """
+    path = getattr(settings, 'MONGOREVERSION_USER_LOADER', None)
+    if not path:
+        return load_users
+    if path not in _user_loaders:
+        module_name, function_name = path.rsplit('.', 1)
+        _user_loaders[path] = getattr(import_module(module_name), function_name)
+    return _user_loaders[path]
+
+# callbacks called with (operation, phase, duration, commands) after each 
+# instrumented phase of save_revision, materialize, diff and revert, see 
+# add_metrics_listener
+_metrics_listeners = []
+
+def add_metrics_listener(callback):
+    """
+        Registers a callback called with the operation and phase names, the 
+        duration in seconds and the number of mongo commands issued (None 
+        unless the command counter of mongoreversion.monitoring is registered)
+        after each instrumented phase. Phases are not timed at all while no 
+        callback is registered.
+    """
+    if callback not in _metrics_listeners:
+        _metrics_listeners.append(callback)
+
+def remove_metrics_listener(callback):
+    if callback in _metrics_listeners:
+        _metrics_listeners.remove(callback)
+
+class _Phase(object):
+
+    def __init__(self, operation, phase):
+        self.operation = operation
+        self.phase = phase
+
+    def __enter__(self):
+        self.commands = command_counter.snapshot()['commands'] if command_counter.registered else None
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self.start
+        commands = None
+        if self.commands is not None:
+            commands = command_counter.snapshot()['commands'] - self.commands
+        for callback in list(_metrics_listeners):
+            callback(self.operation, self.phase, duration, commands)
+        return False
+
+class _NoPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_no_phase = _NoPhase()
+
+def _phase(operation, phase):
+    if not _metrics_listeners:
+        return _no_phase
+    return _Phase(operation, phase)
+
+def _revert_update(son, live_son, db_fields):
+    """
+        Returns the $set/$unset update turning the given live document into the
+        given one for the given fields, or None if they are the same.
+    """
+    set_values = {}
+    unset_values = {}
+    for db_field in db_fields:
+        if db_field in son:
+            if db_field not in live_son or live_son[db_field] != son[db_field]:
+                set_values[db_field] = son[db_field]
+        elif db_field in live_son:
+            unset_values[db_field] = ''
+    update = {}
+    if set_values:
+        update['$set'] = set_values
+    if unset_values:
+        update['$unset'] = unset_values
+    return update or None
+
+def _canonical_default(value):
+    if isinstance(value, datetime):
+        # mongo stores datetimes with millisecond precision
+        return {'$date': value.replace(microsecond=value.microsecond // 1000 * 1000).isoformat()}
+    return {'$%s' % (type(value).__name__, ): str(value)}
+
+def canonical_hash(*values):
+    """
+        Returns a stable hash of the given values, independent of dict 
+        ordering and of the round trip through mongo.
+    """
+    canonical = json.dumps(values, sort_keys=True, separators=(',', ':'), default=_canonical_default)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+# process-wide lookups of class name -> ContentType and ID -> ContentType, see
+# ContentType.get_for_class_name and ContentType.get_for_id
+_content_type_cache = {}
+_content_type_id_cache = {}
+
 class ContentType(Document):
     class_name = StringField(max_length=100, unique=True)
 
@@ -49,73 +506,464 @@ class ContentType(Document):
     def document_model(self):
         return _document_registry.get(self.class_name, None)
 
+    def delete(self, *args, **kwargs):
+        ContentType.clear_cache(self.class_name)
+        return super(ContentType, self).delete(*args, **kwargs)
+
+    @staticmethod
+    def get_for_class_name(class_name, create=False):
+        """
+            Returns the ContentType for the given document class name, hitting
+            the database only the first time a class name is seen by this 
+            process. Returns None if it does not exist and create is False.
+        """
+        content_type = _content_type_cache.get(class_name)
+        if content_type is None:
+            if create:
+                content_type, is_new = ContentType.objects.get_or_create(class_name=class_name)
+            else:
+                try:
+                    content_type = ContentType.objects.get(class_name=class_name)
+                except ContentType.DoesNotExist:
+                    return None
+            _content_type_cache[class_name] = content_type
+            _content_type_id_cache[content_type.pk] = content_type
+        return content_type
+
+    @staticmethod
+    def get_for_id(content_type_id):
+        """
+            Returns the ContentType with the given ID, hitting the database only
+            the first time the ID is seen by this process.
+        """
+        content_type = _content_type_id_cache.get(content_type_id)
+        if content_type is None:
+            content_type = ContentType.objects.get(pk=content_type_id)
+            _content_type_cache[content_type.class_name] = content_type
+            _content_type_id_cache[content_type.pk] = content_type
+        return content_type
+
+    @staticmethod
+    def clear_cache(class_name=None):
+        """
+            Invalidate the cached ContentType for the given class name, or the
+            whole cache if no class name is given. Must be called if the 
+            contenttypes collection is modified outside of this process.
+        """
+        if class_name is None:
+            _content_type_cache.clear()
+            _content_type_id_cache.clear()
+        else:
+            content_type = _content_type_cache.pop(class_name, None)
+            if content_type is not None:
+                _content_type_id_cache.pop(content_type.pk, None)
+
+class _StoredDictField(DictField):
+    """
+        A DictField read as stored: the DictField descriptor turns nested 
+        dicts with _cls into documents and dereferences the references 
+        within, even with a plain item field.
+    """
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return BaseField.__get__(self, instance, owner)
+
+class _InstanceDataField(_StoredDictField):
+    """
+        The instance data of a revision, decompressed from 
+        instance_data_compressed on first access, so that loading compressed
+        revisions only decompresses the ones that are read.
+    """
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        data = instance._data.get(self.name)
+        if not data and instance._data.get('compression') and instance._data.get('instance_data_compressed'):
+            data = instance._data[self.name] = compression.decompress(instance._data['instance_data_compressed'], instance._data['compression'])
+        return data
+
 class Revision(Document):
     user_id = StringField(required=True)
     timestamp = DateTimeField(default=datetime.now, required=True)
-    instance_data = DictField()
+    # the instance data is kept as captured, see _StoredDictField
+    instance_data = _InstanceDataField(BaseField())
     instance_related_revisions = DictField()
     instance_type = ReferenceField(ContentType, dbref=False, required=True)
     instance_id = ObjectIdField(required=True)
     comment = StringField(required=False)
+    # delta storage: instance_data only holds the fields changed from 
+    # base_revision, delta_depth counts the deltas back to the full snapshot
+    base_revision = ObjectIdField(required=False)
+    delta_depth = IntField(default=0)
+    unset_fields = ListField(StringField())
+    # hash of the full instance data and related revisions, see canonical_hash
+    content_hash = StringField(required=False)
+    # flat list of the revision IDs in instance_related_revisions, indexed so
+    # that pruning can tell which revisions are still referenced
+    related_revision_ids = ListField(ObjectIdField())
+    # hash of each captured field and its related revisions, and the names of
+    # the fields that changed from the previous revision
+    field_hashes = DictField()
+    changed_fields = ListField(StringField())
+    # compressed storage: instance_data is stored empty and its content is 
+    # kept in instance_data_compressed, decompressed into instance_data when 
+    # it is first read, see compression.py
+    instance_data_compressed = BinaryField(required=False)
+    compression = StringField(required=False)
+
+    meta = {
+        'indexes': [
+            # serves latest_revision, revisions and revisions_count, the _id 
+            # breaks ties between revisions saved within the same timestamp, 
+            # the content hash is compared by save_revision, which loads a 
+            # small projection of the latest revision, see 
+            # LATEST_REVISION_FIELDS
+            ('instance_type', 'instance_id', '-timestamp', '-id', 'content_hash'), 
+            'related_revision_ids', 
+            # serves revert_user_changes
+            ('user_id', '-timestamp'), 
+            # serves changes_to
+            ('instance_type', 'changed_fields', '-timestamp'), 
+            # serves compress_existing_revisions, which walks the uncompressed
+            # revisions of a document class in _id order
+            ('instance_type', 'compression', 'id'), 
+        ], 
+    }
 
     def __init__(self, *args, **kwargs):
         super(Revision, self).__init__(*args, **kwargs)
-        
-        # create lookup of related field types
-        related_field_types = {}
-        instance_model = self.instance_type.document_model()
-        for key, field in instance_model._fields.items():
-            related_field_type = None
-            if isinstance(field, ListField):
-                if isinstance(field.field, ReferenceField):
-                    related_field_type = field.field.document_type_obj
-            elif isinstance(field, ReferenceField):
-                related_field_type = field.document_type_obj
-            if related_field_type:
-                related_field_types[key] = related_field_type
-        self.related_field_types = related_field_types
-
+        self._full_instance_data = None
+        self._user_cache = _unresolved
 
     def __unicode__(self):
-        return '<Revision user=%s, time=%s, type=%s, comment=%s, >' % (self.user_id, self.timestamp, self.instance_type, self.comment, )
+        return '<Revision user=%s, time=%s, type=%s, comment=%s, >' % (self.user_id, self.timestamp, self.content_type, self.comment, )
+
+    @property
+    def instance_type_id(self):
+        """
+            Returns the ID of the instance ContentType without dereferencing it.
+        """
+        value = self._data.get('instance_type')
+        if isinstance(value, Document):
+            return value.pk
+        return getattr(value, 'id', value)
+
+    @property
+    def content_type(self):
+        return ContentType.get_for_id(self.instance_type_id)
+
+    @property
+    def instance_model(self):
+        return self.content_type.document_model()
+
+    @property
+    def related_field_types(self):
+        return related_field_types(self.instance_model)
+
+    @property
+    def structured_fields(self):
+        return structured_fields(self.instance_model)
 
     @property
     def instance(self):
-        instance_model = self.instance_type.document_model()
-        data = dict(self.instance_data)
+        return Revision.materialize([self])[0]
+
+    @property
+    def is_delta(self):
+        return bool(self.base_revision)
+
+    @property
+    def full_instance_data(self):
+        """
+            Returns the complete instance data of this revision, replaying the 
+            deltas since the last full snapshot if it is stored as a delta.
+        """
+        if self._full_instance_data is None:
+            if not self.is_delta:
+                self._full_instance_data = dict(self.instance_data)
+            else:
+                self._full_instance_data = self._replay_deltas()
+        return self._full_instance_data
+
+    def compress(self, method):
+        """
+            Stores the instance data of this unsaved revision in compressed 
+            form, instance_data keeps it in memory.
+        """
+        self.instance_data_compressed = compression.compress(self._fields['instance_data'].to_mongo(self.instance_data), method)
+        self.compression = method
+
+    def to_mongo(self, *args, **kwargs):
+        son = super(Revision, self).to_mongo(*args, **kwargs)
+        # compressed instance data is only stored in instance_data_compressed
+        if self.compression and 'instance_data' in son:
+            son['instance_data'] = {}
+        return son
+
+    def _replay_deltas(self, chain=None):
+        # the deltas back to the full snapshot are the delta_depth revisions 
+        # preceding this one, so fetch them all with one query, unless 
+        # resolve_deltas loaded them
+        if chain is None:
+            chain = Revision.objects.filter(instance_type=self.instance_type_id, instance_id=self.instance_id, timestamp__lte=self.timestamp).order_by('-timestamp', '-id').limit(self.delta_depth + 1)
+            chain = dict((revision.pk, revision) for revision in chain)
+        deltas = []
+        revision = self
+        while revision.is_delta and revision._full_instance_data is None:
+            deltas.append(revision)
+            base_revision = chain.get(revision.base_revision)
+            if base_revision is None:
+                base_revision = Revision.objects.get(pk=revision.base_revision)
+            revision = base_revision
+        data = dict(revision.full_instance_data)
+        for delta in reversed(deltas):
+            for path in delta.unset_fields:
+                _set_path(data, path, unset=True)
+            for path, value in delta.instance_data.items():
+                _set_path(data, path, value)
+        return data
+
+    def collect_related_revision_ids(self):
+        revision_ids = []
+        for value in self.instance_related_revisions.values():
+            for revision_id in (value if isinstance(value, (list, tuple)) else [value]):
+                if revision_id and revision_id not in revision_ids:
+                    revision_ids.append(revision_id)
+        return revision_ids
+
+    def compute_content_hash(self):
+        return canonical_hash(self.full_instance_data, self.instance_related_revisions)
+
+    def compute_field_hashes(self):
+        # the revisions of references nested in a structured field are stored 
+        # by path, hash them with that field
+        related = dict(self.instance_related_revisions)
+        for path, revision_id in self.instance_related_revisions.items():
+            if PATH_SEPARATOR in path:
+                related.setdefault(path.split(PATH_SEPARATOR)[0], {})[path] = revision_id
+        return dict((key, canonical_hash(value, related.get(key))) for key, value in self.full_instance_data.items() if key != 'id')
+
+    def compute_changed_fields(self, revision=None):
+        """
+            Returns the sorted names of the fields that changed from the given 
+            revision, by field hash, or of all fields if there is none.
+        """
+        if revision is None:
+            return sorted(self.field_hashes.keys())
+        previous_hashes = revision.field_hashes
+        changed = set(key for key, value in self.field_hashes.items() if previous_hashes.get(key) != value)
+        changed.update(key for key in previous_hashes if key not in self.field_hashes)
+        return sorted(changed)
+
+    def make_delta(self, base_revision):
+        """
+            Converts this unsaved revision to a delta relative to the given 
+            revision, keeping only the fields that changed. Changes nested in 
+            structured fields are kept by path, see structural_diff.
+        """
+        data = self.full_instance_data
+        base_data = base_revision.full_instance_data
+        structured = self.structured_fields
+        self.instance_data = {}
+        self.unset_fields = [key for key in base_data if key not in data]
         for key, value in data.items():
-            if key in self.related_field_types:
-                if key in self.instance_related_revisions:
-                    revision_value = self.instance_related_revisions.get(key)
-                    if isinstance(revision_value, (list, tuple)):
-                        values = []
-                        for i, rev_id in enumerate(revision_value):
-                            if rev_id:
-                                revision = Revision.objects.get(pk=rev_id)
-                                values.append(revision.instance)
-                            else:
-                                obj_id = value[i]
-                                values.append(self.related_field_types.get(key).objects.get(pk=obj_id))
-                        data[key] = values
-                    else:
-                        if value:
-                            revision = Revision.objects.get(pk=value)
-                            data[key] = revision.instance
-                        else:
-                            data[key] = self.related_field_types.get(key).objects.get(pk=value)
+            if key not in base_data:
+                self.instance_data[key] = value
+            elif base_data[key] != value:
+                if key in structured:
+                    changes, removed = structural_diff(base_data[key], value, key)
+                    self.instance_data.update(changes)
+                    self.unset_fields.extend(removed)
                 else:
-                    if isinstance(value, (list, tuple)):
-                        data[key] = [self.related_field_types.get(key).objects.get(pk=v) for v in value]
+                    self.instance_data[key] = value
+        self.base_revision = base_revision.pk
+        self.delta_depth = base_revision.delta_depth + 1
+
+    def related_references(self):
+        """
+            Returns a list of (key, is_list, document class, references) 
+            tuples for the related fields of this revision, references being a
+            list of (object ID, revision ID) pairs. The revision ID is None 
+            where the live related document is to be used. References nested 
+            in structured fields are keyed by their path.
+        """
+        references = []
+        for key, value in self.full_instance_data.items():
+            if key in self.structured_fields:
+                for path, document_type, object_id in _nested_references(self.structured_fields[key], value, key):
+                    references.append((path, False, document_type, [(object_id, self.instance_related_revisions.get(path))]))
+                continue
+            if key not in self.related_field_types:
+                continue
+            revision_value = self.instance_related_revisions.get(key)
+            is_list = isinstance(value, (list, tuple))
+            if is_list:
+                object_ids = list(value)
+                revision_ids = list(revision_value) if isinstance(revision_value, (list, tuple)) else []
+                revision_ids += [None] * (len(object_ids) - len(revision_ids))
+            else:
+                object_ids = [value]
+                revision_ids = [revision_value]
+            references.append((key, is_list, self.related_field_types[key], list(zip(object_ids, revision_ids))))
+        return references
+
+    @staticmethod
+    def resolve_deltas(revisions):
+        """
+            Replays the given revisions stored as deltas, loading the 
+            revisions they are replayed from with two queries in all, so that 
+            accessing their full instance data does not hit the database.
+        """
+        deltas = [revision for revision in revisions if revision.is_delta and revision._full_instance_data is None]
+        if not deltas:
+            return
+        # the chains are made of earlier revisions of the same documents, 
+        # find them along the revision index, then load the ones needed
+        candidates = Revision.objects.filter(instance_type__in=list(set(revision.instance_type_id for revision in deltas)), instance_id__in=list(set(revision.instance_id for revision in deltas)), timestamp__lte=max(revision.timestamp for revision in deltas)).only('id', 'base_revision')
+        base_revisions = dict((revision.pk, revision.base_revision) for revision in candidates)
+        chain = dict((revision.pk, revision) for revision in revisions if revision.pk)
+        chain_ids = set()
+        for revision in deltas:
+            revision_id = revision.base_revision
+            while revision_id and revision_id not in chain and revision_id not in chain_ids:
+                chain_ids.add(revision_id)
+                revision_id = base_revisions.get(revision_id)
+        if chain_ids:
+            chain.update(Revision.objects.in_bulk(list(chain_ids)))
+        for revision in deltas:
+            revision._full_instance_data = revision._replay_deltas(chain)
+
+    @staticmethod
+    def materialize(revisions, identity_map=None, as_of=None):
+        """
+            Returns the document instances of the given revisions. Delta 
+            chains, related revisions and documents are fetched in bulk, one 
+            query per collection and nesting level. The identity map (revision ID -> 
+            instance) is shared across levels so that no related revision is 
+            loaded twice.
+
+            Versioned related documents are materialized from the revisions 
+            stored with each revision, or, given an as_of timestamp, from their
+            latest revisions at that time, falling back to the stored ones. 
+            Related documents without either are the live documents, even with
+            as_of.
+        """
+        if identity_map is None:
+            identity_map = {}
+        revisions = list(revisions)
+        with _phase('materialize', 'delta_chains'):
+            Revision.resolve_deltas(revisions)
+        with _phase('materialize', 'references'):
+            references = [revision.related_references() for revision in revisions]
+            if as_of is not None:
+                references = Revision._references_as_of(revisions, references, as_of)
+
+            # collect the IDs to fetch for this level
+            revision_ids = set()
+            object_ids = {}
+            for revision, revision_references in zip(revisions, references):
+                for key, is_list, document_type, pairs in revision_references:
+                    for object_id, revision_id in pairs:
+                        if revision_id:
+                            if revision_id not in identity_map:
+                                revision_ids.add(revision_id)
+                        elif object_id is not None:
+                            object_ids.setdefault(document_type, set()).add(object_id)
+
+        # materialize the related revisions of the next level
+        if revision_ids:
+            with _phase('materialize', 'related_revisions'):
+                related_revisions = Revision.objects.in_bulk(list(revision_ids))
+            if len(related_revisions) != len(revision_ids):
+                raise Revision.DoesNotExist('related revisions not found: %s' % (list(revision_ids - set(related_revisions.keys())), ))
+            Revision.materialize(related_revisions.values(), identity_map, as_of)
+
+        # fetch the unversioned related documents
+        objects = {}
+        with _phase('materialize', 'related_documents'):
+            for document_type, ids in object_ids.items():
+                objects[document_type] = document_type.objects.in_bulk(list(ids))
+                if len(objects[document_type]) != len(ids):
+                    raise document_type.DoesNotExist('related documents not found: %s' % (list(ids - set(objects[document_type].keys())), ))
+
+        instances = []
+        with _phase('materialize', 'build'):
+            for revision, revision_references in zip(revisions, references):
+                data = dict(revision.full_instance_data)
+                for key, field in revision.structured_fields.items():
+                    if data.get(key) is not None:
+                        data[key] = field.to_python(_copy_value(data[key]))
+                nested = []
+                for key, is_list, document_type, pairs in revision_references:
+                    values = []
+                    for object_id, revision_id in pairs:
+                        if revision_id:
+                            values.append(identity_map[revision_id])
+                        elif object_id is not None:
+                            values.append(objects[document_type][object_id])
+                        else:
+                            values.append(None)
+                    if key in data:
+                        data[key] = values if is_list else values[0]
                     else:
-                        data[key] = self.related_field_types.get(key).objects.get(pk=value)
-        return instance_model(**data)
+                        nested.append((key, values[0]))
+                instance = revision.instance_model(**data)
+                for path, value in nested:
+                    _assign_path(instance, path, value)
+                if revision.pk:
+                    identity_map[revision.pk] = instance
+                instances.append(instance)
+        return instances
+
+    @staticmethod
+    def _references_as_of(revisions, references, as_of):
+        # replace the stored revision IDs of versioned related documents by 
+        # the IDs of their revisions at the given time, where they have one, 
+        # with one aggregation per related document class
+        object_ids = {}
+        for revision, revision_references in zip(revisions, references):
+            for key, is_list, document_type, pairs in revision_references:
+                if document_type._meta.get('versioned', None):
+                    object_ids.setdefault(document_type._class_name, set()).update(object_id for object_id, revision_id in pairs if object_id is not None)
+        revision_ids = {}
+        for class_name, ids in object_ids.items():
+            revision_ids.update(Revision.revision_ids_as_of(class_name, ids, as_of))
+
+        references_as_of = []
+        for revision, revision_references in zip(revisions, references):
+            revision_references_as_of = []
+            for key, is_list, document_type, pairs in revision_references:
+                if document_type._meta.get('versioned', None):
+                    pairs = [(object_id, revision_ids.get(object_id, revision_id)) for object_id, revision_id in pairs]
+                revision_references_as_of.append((key, is_list, document_type, pairs))
+            references_as_of.append(revision_references_as_of)
+        return references_as_of
 
     @property
     def user(self):
-        try:
-            return User.objects.get(pk=self.user_id)
-        except User.DoesNotExist:
-            return None
+        """
+            Returns the author of the revision, loaded once per revision with 
+            the configured user loader, or None if it cannot be found.
+        """
+        if self._user_cache is _unresolved:
+            Revision.resolve_users([self])
+        return self._user_cache
+
+    @staticmethod
+    def resolve_users(revisions):
+        """
+            Loads the authors of the given revisions with a single call to the 
+            user loader, so that accessing their user does not hit the 
+            database.
+        """
+        revisions = [revision for revision in revisions if revision._user_cache is _unresolved]
+        user_ids = set(revision.user_id for revision in revisions)
+        users = get_user_loader()(list(user_ids)) if user_ids else {}
+        for revision in revisions:
+            revision._user_cache = users.get(revision.user_id)
 
 
     def diff(self, revision=None):
@@ -124,47 +972,323 @@ class Revision(Document):
             If the given revision is empty, use the latest revision of the 
             document instance.
         """
-        if not revision:
-            revision = Revision.latest_revision(self.instance)
-        if not revision:
-            return self.instance_data
+        with _phase('diff', 'load'):
+            if not revision:
+                revision = Revision.latest_revision(self.instance)
+            if not revision:
+                return dict(self.full_instance_data)
+            revision_data = revision.full_instance_data
         diff_dict = {}
-        for key, value in self.instance_data.items():
-            if value != revision.instance_data.get(key):
-                diff_dict[key] = value
+        with _phase('diff', 'compare'):
+            field_names = versioned_field_names(self.instance_model)
+            for key, value in self.full_instance_data.items():
+                if field_names is not None and key not in field_names:
+                    continue
+                if value != revision_data.get(key):
+                    diff_dict[key] = value
         return diff_dict
 
+    def structural_diff(self, revision=None):
+        """
+            Returns (changes, removed) of the current revision with the given
+            revision, or the latest revision of the document instance, by 
+            path: a change nested in a dict, embedded document or list is 
+            reported at its path only, see structural_diff.
+        """
+        with _phase('diff', 'load'):
+            if not revision:
+                revision = Revision.latest_revision(self.instance)
+            revision_data = revision.full_instance_data if revision else {}
+        with _phase('diff', 'compare'):
+            data = self.full_instance_data
+            field_names = versioned_field_names(self.instance_model)
+            if field_names is not None:
+                data = dict((key, value) for key, value in data.items() if key in field_names)
+                revision_data = dict((key, value) for key, value in revision_data.items() if key in field_names)
+            return structural_diff(revision_data, data)
+
     def revert(self):
         """
-            Revert the associated document instance back to this revision.
+            Revert the associated document instance back to this revision, 
+            updating only the fields that differ from the live document.
             Return the document instance.
         """
-        self.instance.save()
-        return self.instance
+        return Revision.revert_many([self])[0]
+
+    @staticmethod
+    def revert_many(revisions):
+        """
+            Reverts the documents of the given revisions back to them, in the 
+            given order, and returns the reverted documents. The revisions are 
+            materialized together, and each collection costs one query for the
+            live documents and one bulk write of $set/$unset updates of the 
+            versioned fields that differ (or inserts of deleted documents).
+        """
+        revisions = list(revisions)
+        with _phase('revert', 'materialize'):
+            instances = Revision.materialize(revisions)
+        instances_by_model = {}
+        for instance in instances:
+            instances_by_model.setdefault(type(instance), []).append(instance)
+
+        reverted = {}
+        for instance_model, model_instances in instances_by_model.items():
+            instance_ids = [instance.pk for instance in model_instances]
+            collection = instance_model._get_collection()
+            with _phase('revert', 'live_documents'):
+                live = dict((son['_id'], son) for son in collection.find({'_id': {'$in': instance_ids}}))
+            field_names = versioned_field_names(instance_model)
+            if field_names is None:
+                field_names = instance_model._fields.keys()
+            db_fields = [instance_model._fields[name].db_field for name in field_names if name in instance_model._fields and name != 'id']
+
+            requests = []
+            for instance in model_instances:
+                son = instance.to_mongo()
+                if instance.pk not in live:
+                    requests.append(InsertOne(son))
+                    live[instance.pk] = son
+                    continue
+                update = _revert_update(son, live[instance.pk], db_fields)
+                if update:
+                    requests.append(UpdateOne({'_id': instance.pk}, update))
+                    # a later revision of the same document is reverted from 
+                    # this one
+                    live_son = dict(live[instance.pk])
+                    live_son.update(update.get('$set', {}))
+                    for db_field in update.get('$unset', {}):
+                        live_son.pop(db_field, None)
+                    live[instance.pk] = live_son
+            if requests:
+                with _phase('revert', 'write'):
+                    collection.bulk_write(requests, ordered=True)
+            with _phase('revert', 'reload'):
+                for instance_id, document in instance_model.objects.in_bulk(instance_ids).items():
+                    reverted[(instance_model, instance_id)] = document
+        return [reverted[(type(instance), instance.pk)] for instance in instances]
+
+    @staticmethod
+    def revert_user_changes(user, since):
+        """
+            Reverts every document the given user saved a revision of since the
+            given time to its latest revision from before then, which also 
+            undoes later changes by other users. Documents without a revision 
+            from before then are left as they are. Returns the reverted 
+            documents.
+        """
+        pipeline = [
+            {'$match': {'user_id': str(user.pk), 'timestamp': {'$gte': since}}}, 
+            {'$group': {'_id': {'instance_type': '$instance_type', 'instance_id': '$instance_id'}}}, 
+        ]
+        instance_ids = {}
+        for result in _aggregate(Revision, pipeline):
+            instance_ids.setdefault(result['_id']['instance_type'], set()).add(result['_id']['instance_id'])
+        revision_ids = []
+        for instance_type_id, ids in instance_ids.items():
+            class_name = ContentType.get_for_id(instance_type_id).class_name
+            revision_ids.extend(Revision.revision_ids_as_of(class_name, ids, since, inclusive=False).values())
+        if not revision_ids:
+            return []
+        return Revision.revert_many(Revision.objects.in_bulk(revision_ids).values())
 
     @staticmethod
     def latest_revision(instance):
+        instance_type = ContentType.get_for_class_name(instance._class_name)
+        if instance_type is None:
+            return None
+        return Revision.objects.filter(instance_type=instance_type, instance_id=instance.pk).order_by('-timestamp', '-id').first()
+
+    @staticmethod
+    def history(instance, limit=20, cursor=None, fields=None):
+        """
+            Returns (revisions, next_cursor) for a page of the revision history
+            of the given instance, newest first. Pages are keyed on the 
+            (timestamp, id) of the last revision of the previous page, so any 
+            page costs a single indexed query. Only the revision metadata is 
+            loaded unless the fields to load are given. next_cursor is None on
+            the last page.
+        """
+        instance_type = ContentType.get_for_class_name(instance._class_name)
+        if instance_type is None:
+            return [], None
+        revisions = Revision.objects.filter(instance_type=instance_type, instance_id=instance.pk)
+        if cursor:
+            timestamp, revision_id = Revision.parse_cursor(cursor)
+            revisions = revisions.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=revision_id))
+        if fields:
+            fields = list(fields)
+            # compressed instance data is loaded from instance_data_compressed
+            if 'instance_data' in fields:
+                fields.extend(['instance_data_compressed', 'compression'])
+            revisions = revisions.only(*fields)
+        else:
+            revisions = revisions.exclude(*REVISION_PAYLOAD_FIELDS)
+        revisions = list(revisions.order_by('-timestamp', '-id').limit(limit + 1))
+        if len(revisions) <= limit:
+            return revisions, None
+        revisions = revisions[:limit]
+        return revisions, revisions[-1].cursor
+
+    @staticmethod
+    def iter_history(instance, page_size=100, fields=None):
+        """
+            Iterates over the whole revision history of the given instance, 
+            newest first, a page at a time.
+        """
+        cursor = None
+        while True:
+            revisions, cursor = Revision.history(instance, page_size, cursor, fields)
+            for revision in revisions:
+                yield revision
+            if not cursor:
+                return
+
+    @property
+    def cursor(self):
+        return '%s_%s' % (self.timestamp.strftime(CURSOR_TIMESTAMP_FORMAT), self.pk, )
+
+    @staticmethod
+    def parse_cursor(cursor):
         try:
-            instance_type = ContentType.objects.get(class_name=instance._class_name)
-            revisions = Revision.objects.filter(instance_type=instance_type, instance_id=instance.pk).order_by('-timestamp')
-            if revisions.count() > 0:
-                return revisions[0]
-        except ContentType.DoesNotExist:
-            pass
-        return None
+            timestamp, revision_id = cursor.split('_')
+            return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), ObjectId(revision_id)
+        except Exception:
+            raise ValueError('invalid revision history cursor: %r' % (cursor, ))
+
+    @staticmethod
+    def history_count(instance, cached=False, max_count=None):
+        """
+            Returns the number of revisions of the given instance. With cached
+            and the MONGOREVERSION_COUNT_CACHE_TIMEOUT setting, the count is 
+            kept in the Django cache for that many seconds or until revisions 
+            of the instance are saved or pruned. With max_count, counting stops
+            there and the count is not cached.
+        """
+        instance_type = ContentType.get_for_class_name(instance._class_name)
+        if instance_type is None:
+            return 0
+        key = Revision.history_count_key(instance_type.pk, instance.pk)
+        timeout = getattr(settings, 'MONGOREVERSION_COUNT_CACHE_TIMEOUT', None)
+        cached = cached and timeout is not None and not max_count
+        if cached:
+            count = cache.get(key)
+            if count is not None:
+                return count
+        revisions = Revision.objects.filter(instance_type=instance_type, instance_id=instance.pk)
+        if max_count:
+            count = revisions.limit(max_count).count(True)
+        else:
+            count = revisions.count()
+        if cached:
+            cache.set(key, count, timeout)
+        return count
+
+    @staticmethod
+    def history_count_key(instance_type_id, instance_id):
+        return 'mongoreversion:history_count:%s:%s' % (instance_type_id, instance_id, )
+
+    @staticmethod
+    def clear_history_counts(instances):
+        """
+            Drops the cached history counts of the given (instance type ID, 
+            instance ID) pairs, if history counts are cached at all.
+        """
+        if getattr(settings, 'MONGOREVERSION_COUNT_CACHE_TIMEOUT', None) is None:
+            return
+        cache.delete_many([Revision.history_count_key(instance_type_id, instance_id) for instance_type_id, instance_id in instances])
 
     @staticmethod
-    def save_revision(user, instance, comment=None):
-        if not instance._meta.get('versioned', None):
-            raise ValueError('instance meta does not specify it to be versioned, set versioned=True to enable')
+    def latest_revision_ids(instances):
+        """
+            Returns a dict mapping instance ID -> latest revision ID for the 
+            given document instances, resolved with a single aggregation per 
+            document class. Instances without any revision are left out.
+        """
+        instance_ids_by_class = {}
+        for instance in instances:
+            if instance is not None and instance.pk:
+                instance_ids_by_class.setdefault(instance._class_name, set()).add(instance.pk)
 
-        instance_type, is_new = ContentType.objects.get_or_create(class_name=instance._class_name)
+        latest_ids = {}
+        for class_name, instance_ids in instance_ids_by_class.items():
+            latest_ids.update(Revision.revision_ids_as_of(class_name, instance_ids))
+        return latest_ids
+
+    @staticmethod
+    def changes_to(document_class, field, since=None, instance=None):
+        """
+            Returns the revisions of documents of the given class that changed 
+            the given field, newest first, optionally only those saved since the
+            given time or of the given instance. A single indexed query.
+        """
+        instance_type = ContentType.get_for_class_name(document_class._class_name)
+        if instance_type is None:
+            return Revision.objects.none()
+        revisions = Revision.objects.filter(instance_type=instance_type, changed_fields=field)
+        if since is not None:
+            revisions = revisions.filter(timestamp__gte=since)
+        if instance is not None:
+            revisions = revisions.filter(instance_id=instance.pk)
+        return revisions.order_by('-timestamp')
+
+    @staticmethod
+    def revision_ids_as_of(class_name, instance_ids, timestamp=None, inclusive=True):
+        """
+            Returns a dict mapping instance ID -> ID of the latest revision 
+            saved at or before the given timestamp (strictly before unless 
+            inclusive, or the latest revision if no timestamp is given) for the
+            given instances of a document class, with a single aggregation.
+        """
+        instance_type = ContentType.get_for_class_name(class_name)
+        if instance_type is None or not instance_ids:
+            return {}
+        match = {'instance_type': instance_type.pk, 'instance_id': {'$in': list(instance_ids)}}
+        if timestamp is not None:
+            match['timestamp'] = {'$lte' if inclusive else '$lt': timestamp}
+        pipeline = [
+            {'$match': match}, 
+            {'$sort': SON([('instance_id', 1), ('timestamp', -1), ('_id', -1)])}, 
+            {'$group': {'_id': '$instance_id', 'revision_id': {'$first': '$_id'}}}, 
+        ]
+        return dict((result['_id'], result['revision_id']) for result in _aggregate(Revision, pipeline))
+
+    @staticmethod
+    def latest_revisions(instances, fields=None):
+        """
+            Returns a dict mapping instance ID -> latest revision for the given
+            document instances, loading only the given fields if any. A batch 
+            costs two queries, a single instance one.
+        """
+        instances = [instance for instance in instances if instance is not None and instance.pk]
+        if len(instances) == 1:
+            instance_type = ContentType.get_for_class_name(instances[0]._class_name)
+            if instance_type is None:
+                return {}
+            revisions = Revision.objects.filter(instance_type=instance_type, instance_id=instances[0].pk).order_by('-timestamp', '-id').limit(1)
+        else:
+            latest_ids = Revision.latest_revision_ids(instances)
+            if not latest_ids:
+                return {}
+            revisions = Revision.objects.filter(pk__in=list(latest_ids.values()))
+        if fields:
+            revisions = revisions.only(*fields)
+        return dict((revision.instance_id, revision) for revision in revisions)
+
+    @staticmethod
+    def capture(instance):
+        """
+            Returns (instance_data, related_documents) for the given document 
+            instance: the data of its versioned fields with references replaced
+            by object IDs, and a dict of versioned related field name -> 
+            document(s) whose latest revision is to be stored with it.
+        """
         instance_data = dict(instance._data)
-        instance_related_revisions = {}
 
-        # ensure instance has been saved at least once
-        if not instance.pk:
-            instance.save()
+        # only capture the configured fields
+        field_names = versioned_field_names(type(instance))
+        if field_names is not None:
+            instance_data = dict((key, value) for key, value in instance_data.items() if key in field_names)
+        versioned_related = instance._meta.get('versioned_related', None)
 
         # Save instance ID in data dict
         instance_data['id'] = instance.pk
@@ -173,74 +1297,182 @@ class Revision(Document):
         if None in instance_data:
             del instance_data[None]
 
-        # create lookup of related field types
-        related_field_types = {}
-        for key, field in instance._fields.items():
-            related_field_type = None
-            if isinstance(field, ListField):
-                if isinstance(field.field, ReferenceField):
-                    related_field_type = field.field.document_type_obj
-            elif isinstance(field, ReferenceField):
-                related_field_type = field.document_type_obj
-            # TODO: elif isinstance(field, DictField):
-
-            if related_field_type:
-                related_field_types[key] = related_field_type
-
         # process field data
+        field_types = related_field_types(type(instance))
+        structured = structured_fields(type(instance))
+        related_documents = {}
         for key, value in instance_data.items():
 
-            if key in related_field_types:
+            if key in structured:
 
-                # check if related field is versioned, store revision data
-                if related_field_types.get(key)._meta.get('versioned', None):
+                # store nested values in their mongo form, the versioned 
+                # related documents within are stored by path
+                instance_data[key] = value = _capture_value(structured[key], value)
+                if versioned_related is None or key in versioned_related:
+                    for path, document_type, object_id in _nested_references(structured[key], value, key):
+                        if document_type._meta.get('versioned', None):
+                            related_documents[path] = _as_document(document_type, object_id)
 
-                    # versioned, store revision ID(s)
-                    if isinstance(value, (list, tuple)):
-                        id_revisions = []
-                        for v in value:
-                            revision = Revision.latest_revision(v)
-                            # TODO: if latest revision doesn't exist then maybe
-                            # it should be created here
-                            if revision:
-                                id_revisions.append(revision.pk)
-                            else:
-                                # if no revision exists, then explicitely 
-                                # store a None entry
-                                id_revisions.append(None)
-                            instance_related_revisions[key] = id_revisions
-                    else:
-                        revision = Revision.latest_revision(value)
-                        # TODO: if latest revision doesn't exist then maybe it 
-                        # should be created here
-                        if revision:
-                            instance_related_revisions[key] = revision.pk
-                        else:
-                            # if no revision exists, then explicitely store a
-                            # None entry
-                            instance_related_revisions[key] = None
+            elif key in field_types:
+
+                # references that were never dereferenced hold IDs only
+                if isinstance(value, (list, tuple)):
+                    value = [_as_document(field_types.get(key), v) for v in value]
+                else:
+                    value = _as_document(field_types.get(key), value)
+
+                # check if related field is versioned, its revision(s) will be 
+                # stored with the revision
+                if field_types.get(key)._meta.get('versioned', None) and (versioned_related is None or key in versioned_related):
+                    related_documents[key] = value
 
                 # store object ID(s) in instance_data
                 if isinstance(value, (list, tuple)):
                     instance_data[key] = [v.pk for v in value]
-                else:
+                elif value is not None:
                     instance_data[key] = value.pk
 
-            else:
-                # store data as is
-                instance_data[key] = value
-
-        # create the revision, but do not save it yet
-        revision = Revision(user_id=str(user.pk), timestamp=datetime.now(), instance_type=instance_type, instance_data=instance_data, instance_related_revisions=instance_related_revisions, instance_id=instance.pk, comment=comment)
-
-        # check for any differences in data from lastest revision
-        # return the latest revision if no difference
-        latest_revision = Revision.latest_revision(instance)
-        if latest_revision:
-            diff = revision.diff(latest_revision)
-            if not diff:
-                return latest_revision, False
-
-        # save revision and return
-        revision.save()
-        return revision, True
+        return instance_data, related_documents
+
+    @staticmethod
+    def _delta_due(instance, latest_revision):
+        # in delta storage mode only store the changes from the latest saved
+        # revision, unless a full snapshot is due
+        if instance._meta.get('revision_storage', REVISION_STORAGE_FULL) != REVISION_STORAGE_DELTA or not latest_revision.pk:
+            return False
+        keyframe_interval = instance._meta.get('revision_keyframe_interval', DEFAULT_KEYFRAME_INTERVAL)
+        return latest_revision.delta_depth + 1 < keyframe_interval
+
+    @staticmethod
+    def save_revision(user, instance, comment=None, timestamp=None):
+        return Revision.save_revisions(user, [instance], comment, [timestamp] if timestamp else None)[0]
+
+    @staticmethod
+    def save_revisions(user, instances, comment=None, timestamps=None):
+        """
+            Saves a revision of each of the given document instances and 
+            returns a list of (revision, is_new) tuples in the same order. If an
+            instance has not changed since its latest revision, that revision 
+            is returned with is_new False. timestamps optionally gives the time
+            each instance was captured at, for revisions saved later on, the 
+            current time is used otherwise.
+
+            Content types, related revisions and latest revisions are resolved
+            for the whole batch at once, and the new revisions are written with
+            a single insert. Related documents are pinned to their latest 
+            revision from before the batch.
+        """
+        instances = list(instances)
+        now = datetime.now()
+        timestamps = list(timestamps) if timestamps else [None] * len(instances)
+        for instance in instances:
+            if not instance._meta.get('versioned', None):
+                raise ValueError('instance meta does not specify it to be versioned, set versioned=True to enable')
+
+            # ensure instance has been saved at least once
+            if not instance.pk:
+                instance.save()
+
+        with _phase('save_revision', 'content_types'):
+            instance_types = [ContentType.get_for_class_name(instance._class_name, create=True) for instance in instances]
+
+        with _phase('save_revision', 'capture'):
+            captures = [Revision.capture(instance) for instance in instances]
+
+        # resolve the latest revisions of all versioned related documents
+        with _phase('save_revision', 'related_revisions'):
+            related_documents = []
+            for instance_data, related in captures:
+                for value in related.values():
+                    related_documents.extend(value if isinstance(value, (list, tuple)) else [value])
+            related_latest_ids = Revision.latest_revision_ids(related_documents)
+
+        # create the revisions, but do not save them yet
+        # TODO: if the latest revision of a related document doesn't exist then
+        # maybe it should be created here, for now explicitely store a None 
+        # entry
+        revisions = []
+        with _phase('save_revision', 'build'):
+            for instance, instance_type, timestamp, (instance_data, related) in zip(instances, instance_types, timestamps, captures):
+                instance_related_revisions = {}
+                for key, value in related.items():
+                    if isinstance(value, (list, tuple)):
+                        instance_related_revisions[key] = [related_latest_ids.get(v.pk) for v in value]
+                    else:
+                        instance_related_revisions[key] = related_latest_ids.get(value.pk) if value is not None else None
+                revision = Revision(user_id=str(user.pk), timestamp=timestamp or now, instance_type=instance_type, instance_data=instance_data, instance_related_revisions=instance_related_revisions, instance_id=instance.pk, comment=comment)
+                revision.content_hash = revision.compute_content_hash()
+                revision.field_hashes = revision.compute_field_hashes()
+                revision.related_revision_ids = revision.collect_related_revision_ids()
+                revisions.append(revision)
+
+        # fetch a projection of the latest revisions with their content hash, 
+        # then the field hashes of those that changed, and the full revisions
+        # that are needed: those saved before content and field hashes were 
+        # stored, and the bases of new deltas
+        with _phase('save_revision', 'latest_revisions'):
+            latest_revisions = Revision.latest_revisions(instances, LATEST_REVISION_FIELDS)
+            payload_ids = []
+            hash_ids = []
+            for instance, revision in zip(instances, revisions):
+                latest_revision = latest_revisions.get(instance.pk)
+                if latest_revision is None or latest_revision.content_hash == revision.content_hash:
+                    continue
+                if not latest_revision.content_hash or Revision._delta_due(instance, latest_revision):
+                    payload_ids.append(latest_revision.pk)
+                else:
+                    hash_ids.append(latest_revision.pk)
+            if hash_ids:
+                for latest_revision in Revision.objects.filter(pk__in=hash_ids).only('id', 'instance_id', 'field_hashes'):
+                    if latest_revision.field_hashes:
+                        latest_revisions[latest_revision.instance_id].field_hashes = latest_revision.field_hashes
+                    else:
+                        payload_ids.append(latest_revision.pk)
+            if payload_ids:
+                for latest_revision in Revision.objects.filter(pk__in=payload_ids):
+                    if not latest_revision.content_hash:
+                        latest_revision.content_hash = latest_revision.compute_content_hash()
+                    if not latest_revision.field_hashes:
+                        latest_revision.field_hashes = latest_revision.compute_field_hashes()
+                    latest_revisions[latest_revision.instance_id] = latest_revision
+            partial_ids = set(revision.pk for revision in latest_revisions.values()) - set(payload_ids)
+
+        # check for any differences from the latest revision by content hash, 
+        # returning the latest revision if there is no difference
+        results = []
+        new_revisions = []
+        with _phase('save_revision', 'diff'):
+            for instance, revision in zip(instances, revisions):
+                latest_revision = latest_revisions.get(instance.pk)
+                if latest_revision is not None:
+                    if latest_revision.content_hash == revision.content_hash:
+                        # identical content, so fill in the payload that was 
+                        # not fetched
+                        if latest_revision.pk in partial_ids:
+                            if not latest_revision.is_delta:
+                                latest_revision.instance_data = revision.instance_data
+                            latest_revision.instance_related_revisions = revision.instance_related_revisions
+                            latest_revision.field_hashes = revision.field_hashes
+                        latest_revision._full_instance_data = revision.full_instance_data
+                        results.append((latest_revision, False))
+                        continue
+                    if Revision._delta_due(instance, latest_revision):
+                        revision.make_delta(latest_revision)
+                revision.changed_fields = revision.compute_changed_fields(latest_revision)
+                # compress the payload where configured
+                method = compression.compression_method(type(instance))
+                if method:
+                    revision.compress(method)
+                # the same instance may occur again later in the batch
+                latest_revisions[instance.pk] = revision
+                new_revisions.append(revision)
+                results.append((revision, True))
+
+        # save the new revisions and return
+        if new_revisions:
+            with _phase('save_revision', 'insert'):
+                revision_ids = Revision.objects.insert(new_revisions, load_bulk=False)
+            for revision, revision_id in zip(new_revisions, revision_ids):
+                revision.pk = revision_id
+            Revision.clear_history_counts([(revision.instance_type_id, revision.instance_id) for revision in new_revisions])
+        return results
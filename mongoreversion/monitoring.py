@@ -0,0 +1,59 @@
+"""
+Counting of the mongo commands issued by this process, per thread.
+
+The counter only sees the clients created after it is registered, either with
+register() or by passing it to connect(event_listeners=[command_counter]).
+mongomock clients issue no command events at all.
+"""
+import threading
+from bson import BSON
+from pymongo import monitoring
+
+# commands whose size is counted as bytes written
+WRITE_COMMANDS = ('insert', 'update', 'delete', 'findAndModify', )
+
+class CommandCounter(monitoring.CommandListener):
+    """
+        Counts the commands started by each thread, and the BSON size of the 
+        write commands among them.
+    """
+
+    def __init__(self):
+        self.registered = False
+        self._local = threading.local()
+
+    def _counts(self):
+        counts = getattr(self._local, 'counts', None)
+        if counts is None:
+            counts = self._local.counts = {'commands': 0, 'bytes_written': 0}
+        return counts
+
+    def started(self, event):
+        counts = self._counts()
+        counts['commands'] += 1
+        if event.command_name in WRITE_COMMANDS:
+            counts['bytes_written'] += len(BSON.encode(event.command))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def snapshot(self):
+        """
+            Returns the counts of the current thread so far.
+        """
+        return dict(self._counts())
+
+command_counter = CommandCounter()
+
+def register():
+    """
+        Registers the command counter with pymongo, for the clients created 
+        from now on.
+    """
+    if not command_counter.registered:
+        monitoring.register(command_counter)
+        command_counter.registered = True
+    return command_counter
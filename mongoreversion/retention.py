@@ -0,0 +1,143 @@
+"""
+Revision retention policies and pruning.
+
+A retention policy is declared per document class in meta['revision_retention'],
+a dict with any of:
+
+    keep_last: number of most recent revisions always kept (at least 1)
+    keep_days: revisions older than this many days are deleted
+    thin_after_days: revisions older than this many days are thinned to the 
+        latest revision per day or week
+    thin_to: 'daily' (the default) or 'weekly'
+
+Revisions still referenced by other revisions, through 
+instance_related_revisions, and the revisions that kept deltas are based on, 
+are never deleted.
+"""
+from datetime import datetime, timedelta
+from mongoengine.base import _document_registry
+from mongoreversion.models import Revision, ContentType, _aggregate
+
+THIN_DAILY = 'daily'
+THIN_WEEKLY = 'weekly'
+
+def retention_policy(document_class):
+    return document_class._meta.get('revision_retention', None)
+
+def retained_document_classes():
+    """
+        Returns the registered document classes declaring a retention policy.
+    """
+    return [document_class for class_name, document_class in sorted(_document_registry.items()) if retention_policy(document_class)]
+
+def _thinning_bucket(timestamp, thin_to):
+    if thin_to == THIN_WEEKLY:
+        return timestamp.isocalendar()[:2]
+    return timestamp.date()
+
+def revisions_to_delete(revisions, policy, now=None, referenced=None):
+    """
+        Returns the IDs of the revisions of a single document that the given 
+        policy deletes. revisions must be ordered newest first and need only
+        have their id, timestamp and base_revision loaded. The revisions whose
+        IDs are in referenced, those still referenced by other revisions, are 
+        kept along with the bases of their deltas.
+    """
+    now = now or datetime.now()
+    keep_last = max(1, policy.get('keep_last') or 1)
+    keep_days = policy.get('keep_days', None)
+    thin_after_days = policy.get('thin_after_days', None)
+    thin_to = policy.get('thin_to', THIN_DAILY)
+
+    keep = set()
+    buckets = set()
+    for i, revision in enumerate(revisions):
+        age = now - revision.timestamp
+        if i < keep_last or (referenced and revision.pk in referenced):
+            keep.add(revision.pk)
+        elif keep_days is not None and age > timedelta(days=keep_days):
+            continue
+        elif thin_after_days is not None and age > timedelta(days=thin_after_days):
+            bucket = _thinning_bucket(revision.timestamp, thin_to)
+            if bucket not in buckets:
+                buckets.add(bucket)
+                keep.add(revision.pk)
+        else:
+            keep.add(revision.pk)
+
+    # keep the revisions that kept deltas are replayed from
+    base_revisions = dict((revision.pk, revision.base_revision) for revision in revisions)
+    for revision_id in list(keep):
+        base_revision = base_revisions.get(revision_id)
+        while base_revision and base_revision not in keep:
+            keep.add(base_revision)
+            base_revision = base_revisions.get(base_revision)
+
+    return [revision.pk for revision in revisions if revision.pk not in keep]
+
+def _next_instance_ids(instance_type, start_after, batch_size):
+    # the distinct instance IDs after start_after, with one aggregation 
+    # matched along the revision index
+    match = {'instance_type': instance_type.pk}
+    if start_after is not None:
+        match['instance_id'] = {'$gt': start_after}
+    pipeline = [
+        {'$match': match}, 
+        {'$group': {'_id': '$instance_id'}}, 
+        {'$sort': {'_id': 1}}, 
+        {'$limit': batch_size}, 
+    ]
+    return [result['_id'] for result in _aggregate(Revision, pipeline)]
+
+def prune_revisions(document_class, batch_size=100, start_after=None, now=None, dry_run=False):
+    """
+        Applies the retention policy of the given document class, a batch of 
+        batch_size documents at a time in instance ID order, starting after 
+        the given instance ID. Yields (last instance ID, deleted count) after 
+        each batch, the last instance ID resumes pruning from there.
+    """
+    policy = retention_policy(document_class)
+    instance_type = ContentType.get_for_class_name(document_class._class_name)
+    if not policy or instance_type is None:
+        return
+    now = now or datetime.now()
+
+    while True:
+        instance_ids = _next_instance_ids(instance_type, start_after, batch_size)
+        if not instance_ids:
+            return
+
+        revisions = Revision.objects.filter(instance_type=instance_type, instance_id__in=instance_ids).only('id', 'instance_id', 'timestamp', 'base_revision').order_by('instance_id', '-timestamp', '-id')
+        revisions_by_instance = {}
+        for revision in revisions:
+            revisions_by_instance.setdefault(revision.instance_id, []).append(revision)
+
+        # revisions still referenced by other revisions stay, and so do the 
+        # bases of their deltas
+        revision_ids = [revision.pk for instance_revisions in revisions_by_instance.values() for revision in instance_revisions]
+        referenced = set(Revision.objects.filter(related_revision_ids__in=revision_ids).distinct('related_revision_ids'))
+        candidates = []
+        for instance_revisions in revisions_by_instance.values():
+            candidates.extend(revisions_to_delete(instance_revisions, policy, now, referenced))
+        if candidates and not dry_run:
+            Revision.objects.filter(pk__in=candidates).delete()
+            instance_id_by_revision = dict((revision.pk, revision.instance_id) for instance_revisions in revisions_by_instance.values() for revision in instance_revisions)
+            Revision.clear_history_counts(set((instance_type.pk, instance_id_by_revision[revision_id]) for revision_id in candidates))
+
+        start_after = instance_ids[-1]
+        yield start_after, len(candidates)
+
+def index_related_revisions(batch_size=1000):
+    """
+        Fills in related_revision_ids for revisions saved before it was 
+        introduced, so that pruning sees their references. Returns the number 
+        of revisions updated.
+    """
+    updated = 0
+    while True:
+        revisions = list(Revision.objects.filter(related_revision_ids__exists=False).only('id', 'instance_related_revisions').limit(batch_size))
+        if not revisions:
+            return updated
+        for revision in revisions:
+            Revision.objects.filter(pk=revision.pk).update_one(set__related_revision_ids=revision.collect_related_revision_ids())
+        updated += len(revisions)
@@ -1,9 +1,14 @@
 from django.contrib.auth.models import User
-from mongoreversion.models import Revision, ReversionedDocument, ContentType
+from mongoreversion.models import Revision, ReversionedDocument, ContentType, related_field_types, structured_fields, structural_diff, add_metrics_listener, remove_metrics_listener
+from mongoreversion import background, backfill, compression, retention
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
 from mongotesting import MongoTestCase
-from mongoengine.document import Document
-from mongoengine.fields import DictField, StringField, ReferenceField, IntField, DateTimeField, ListField
+from mongoengine.document import Document, EmbeddedDocument
+from mongoengine.fields import DictField, StringField, ReferenceField, IntField, DateTimeField, ListField, EmbeddedDocumentField, GenericEmbeddedDocumentField, GenericReferenceField
 from django.template.defaultfilters import slugify
+from django.test.utils import override_settings
+from django.core.cache import cache
 
 class MongoUser(Document):
     username = StringField(max_length=255)
@@ -19,6 +24,9 @@ def create_and_save_sample_mongo_user(suffix=''):
     email = '%s@example.com' % (username, )
     return MongoUser.objects.create(username=username, email=email)
 
+def load_sample_users(user_ids):
+    return dict((user_id, 'user %s' % (user_id, )) for user_id in user_ids)
+
 class SampleTag(Document):
     slug = StringField(max_length=100)
     title = StringField(max_length=100)
@@ -53,6 +61,61 @@ class SampleReversionedDocument(ReversionedDocument):
         'versioned_related': ['tag_models', ], 
     }
 
+class SampleDeltaDocument(Document):
+    slug = StringField(max_length=100)
+    title = StringField(max_length=100)
+    tag_strings = ListField(StringField())
+
+    meta = {
+        'versioned': True, 
+        'versioned_fields': ['title', 'slug', 'tag_strings', ], 
+        'versioned_related': [], 
+        'revision_storage': 'delta', 
+        'revision_keyframe_interval': 3, 
+    }
+
+class SampleCompressedDocument(Document):
+    slug = StringField(max_length=100)
+    title = StringField(max_length=100)
+    body = StringField()
+
+    meta = {
+        'versioned': True, 
+        'revision_compression': 'zlib', 
+    }
+
+class SampleAddress(EmbeddedDocument):
+    street = StringField(max_length=100)
+    city = StringField(max_length=100)
+    tag = ReferenceField(SampleTag, dbref=False)
+    related = GenericReferenceField()
+
+class SampleStructuredDocument(Document):
+    title = StringField(max_length=100)
+    address = EmbeddedDocumentField(SampleAddress)
+    previous_addresses = ListField(EmbeddedDocumentField(SampleAddress))
+    tags_by_name = DictField(ReferenceField(SampleTag, dbref=False))
+    settings = DictField()
+    extra = GenericEmbeddedDocumentField()
+
+    meta = {
+        'versioned': True, 
+        'revision_storage': 'delta', 
+    }
+
+def create_sample_structured_document():
+    tags = []
+    for i in range(2):
+        title = 'Sample Tag %s' % (i, )
+        tag = SampleTag(slug=slugify(title), title=title)
+        tag.save()
+        tags.append(tag)
+    address = SampleAddress(street='1 Sample Street', city='Sample City', tag=tags[0], related=tags[0])
+    previous_addresses = [SampleAddress(street='%s Old Street' % (i, ), city='Old City') for i in range(2)]
+    settings = {'colors': {'background': 'white', 'text': 'black'}, 'sizes': [1, 2, 3]}
+    extra = SampleAddress(street='2 Extra Street', city='Extra City', tag=tags[1])
+    return SampleStructuredDocument(title='Sample Document Title', address=address, previous_addresses=previous_addresses, tags_by_name={'first': tags[0], 'second': tags[1]}, settings=settings, extra=extra)
+
 def create_sample_revisioned_document():
     tag_models = []
     for i in range(3):
@@ -81,8 +144,8 @@ def create_sample_reversioned_document(create_revision_after_save=False):
     doc._meta['create_revision_after_save'] = create_revision_after_save
     return doc
 
-def save_revision_and_check(test, user, doc, comment=None, is_diff=True, instance_save_revision=False):
-    revision, is_new = doc.save_revision(user, comment) if instance_save_revision else Revision.save_revision(user, doc, comment) 
+def save_revision_and_check(test, user, doc, comment=None, is_diff=True, instance_save_revision=False, timestamp=None):
+    revision, is_new = doc.save_revision(user, comment) if instance_save_revision else Revision.save_revision(user, doc, comment, timestamp) 
     test.assertEqual(is_new, is_diff)
     test.assertTrue(revision)
     test.assertTrue(revision.pk)
@@ -97,7 +160,15 @@ def save_revision_and_check(test, user, doc, comment=None, is_diff=True, instanc
         test.assertEqual(value, getattr(doc, key, None))
     return revision
 
-class RevisionModelTest(MongoTestCase):
+class RevisionTestCase(MongoTestCase):
+
+    def setUp(self):
+        super(RevisionTestCase, self).setUp()
+        # the test database is dropped between tests, so cached content types
+        # would point at documents that no longer exist
+        ContentType.clear_cache()
+
+class RevisionModelTest(RevisionTestCase):
 
     def test_create_revision_initial(self):
         """
@@ -190,6 +261,161 @@ class RevisionModelTest(MongoTestCase):
         doc.title = 'New Sample Title'
         save_revision_and_check(self, user, doc, 'another sample comment...')
 
+    def test_create_revision_related_revisions(self):
+        """
+            Test that the latest revisions of related documents are stored.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        tag_revisions = [save_revision_and_check(self, user, tag) for tag in doc.tag_models]
+        doc.tag_models[0].title = 'New Sample Tag Title'
+        tag_revisions[0] = save_revision_and_check(self, user, doc.tag_models[0])
+        revision = save_revision_and_check(self, user, doc, 'sample comment...')
+        self.assertEqual([r.pk for r in tag_revisions], revision.instance_related_revisions['tag_models'])
+
+    def test_latest_revision_ids(self):
+        """
+            Test resolving the latest revisions of many documents at once.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        tag_revisions = [save_revision_and_check(self, user, tag) for tag in doc.tag_models[:2]]
+        doc.tag_models[2].save()
+        latest_ids = Revision.latest_revision_ids(doc.tag_models)
+        self.assertEqual(dict((r.instance_id, r.pk) for r in tag_revisions), latest_ids)
+
+    def test_revision_instance(self):
+        """
+            Test materializing a revision with its related revisions.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            save_revision_and_check(self, user, tag)
+        revision = save_revision_and_check(self, user, doc, 'sample comment...')
+        doc.tag_models[0].title = 'New Sample Tag Title'
+        doc.tag_models[0].save()
+        save_revision_and_check(self, user, doc.tag_models[0])
+        instance = revision.instance
+        self.assertEqual(doc.title, instance.title)
+        self.assertEqual([tag.pk for tag in doc.tag_models], [tag.pk for tag in instance.tag_models])
+        self.assertEqual('Sample Tag 0', instance.tag_models[0].title)
+
+    def test_materialize_identity_map(self):
+        """
+            Test that revisions sharing a related revision get the same instance.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            save_revision_and_check(self, user, tag)
+        rev1 = save_revision_and_check(self, user, doc, 'sample comment...')
+        doc.title = 'New Sample Title'
+        rev2 = save_revision_and_check(self, user, doc, 'another sample comment...')
+        instance1, instance2 = Revision.materialize([rev1, rev2])
+        self.assertEqual('Sample Document Title', instance1.title)
+        self.assertEqual('New Sample Title', instance2.title)
+        self.assertTrue(instance1.tag_models[0] is instance2.tag_models[0])
+
+    def test_create_revision_content_hash(self):
+        """
+            Test that revisions store a hash of their content, unchanged by the 
+            round trip through mongo.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            save_revision_and_check(self, user, tag)
+        revision = save_revision_and_check(self, user, doc, 'sample comment...')
+        self.assertTrue(revision.content_hash)
+        self.assertEqual(revision.content_hash, Revision.objects.get(pk=revision.pk).compute_content_hash())
+
+    def test_create_revision_with_related_diff(self):
+        """
+            Test that a new revision of a related document changes the content.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            save_revision_and_check(self, user, tag)
+        save_revision_and_check(self, user, doc, 'sample comment...')
+        doc.tag_models[0].title = 'New Sample Tag Title'
+        save_revision_and_check(self, user, doc.tag_models[0])
+        save_revision_and_check(self, user, doc, 'another sample comment...')
+
+    def test_create_revision_versioned_fields(self):
+        """
+            Test that only the versioned fields are captured, and that changes 
+            to other fields do not create revisions.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            save_revision_and_check(self, user, tag)
+        revision = save_revision_and_check(self, user, doc, 'sample comment...')
+        self.assertEqual(set(['id', 'title', 'slug', 'tag_models', ]), set(revision.instance_data.keys()))
+        doc.tag_strings = ['four', ]
+        save_revision_and_check(self, user, doc, 'another sample comment...', is_diff=False)
+
+    def test_revert_revision_keeps_unversioned_fields(self):
+        """
+            Test that reverting leaves fields that are not versioned untouched.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            save_revision_and_check(self, user, tag)
+        rev1 = save_revision_and_check(self, user, doc, 'sample comment...')
+        doc.title = 'New Sample Title'
+        doc.tag_strings = ['four', ]
+        doc.save()
+        rev1.revert()
+        doc = SampleDocument.objects.get(pk=doc.pk)
+        self.assertEqual('Sample Document Title', doc.title)
+        self.assertEqual(['four', ], doc.tag_strings)
+
+    def test_save_revisions(self):
+        """
+            Test creating revisions of many documents at once.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            tag.save()
+        results = Revision.save_revisions(user, doc.tag_models, 'sample comment...')
+        self.assertEqual([True, True, True, ], [is_new for revision, is_new in results])
+        self.assertEqual([tag.pk for tag in doc.tag_models], [revision.instance_id for revision, is_new in results])
+        self.assertTrue(all(revision.pk for revision, is_new in results))
+        revision = save_revision_and_check(self, user, doc, 'sample comment...')
+        self.assertEqual([r.pk for r, is_new in results], revision.instance_related_revisions['tag_models'])
+
+        doc.tag_models[1].title = 'New Sample Tag Title'
+        results = Revision.save_revisions(user, doc.tag_models, 'another sample comment...')
+        self.assertEqual([False, True, False, ], [is_new for revision, is_new in results])
+        self.assertEqual(5, Revision.objects.count())
+
+    def test_create_revision_changed_fields(self):
+        """
+            Test that revisions record the fields that changed.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            save_revision_and_check(self, user, tag)
+        rev1 = save_revision_and_check(self, user, doc, 'sample comment...')
+        self.assertEqual(['slug', 'tag_models', 'title', ], rev1.changed_fields)
+        doc.title = 'New Sample Title'
+        rev2 = save_revision_and_check(self, user, doc, 'another sample comment...')
+        self.assertEqual(['title', ], rev2.changed_fields)
+        doc.tag_models[0].title = 'New Sample Tag Title'
+        save_revision_and_check(self, user, doc.tag_models[0])
+        rev3 = save_revision_and_check(self, user, doc, 'another sample comment...')
+        self.assertEqual(['tag_models', ], rev3.changed_fields)
+
+        self.assertEqual([rev2.pk, rev1.pk], [r.pk for r in Revision.changes_to(SampleDocument, 'title')])
+        self.assertEqual([rev2.pk], [r.pk for r in Revision.changes_to(SampleDocument, 'title', since=Revision.objects.get(pk=rev2.pk).timestamp)])
+        self.assertEqual([rev3.pk, rev1.pk], [r.pk for r in Revision.changes_to(SampleDocument, 'tag_models', instance=doc)])
+
     def test_revert_revision(self):
         """
             Test reverting a document back to a specific revision.
@@ -224,7 +450,60 @@ class RevisionModelTest(MongoTestCase):
         self.assertNotEqual(doc1.title, rev2.instance.title)
         self.assertEqual(doc1.title, rev1.instance.title)
 
-class ReversionedDocumentTest(MongoTestCase):
+    def test_revert_many(self):
+        """
+            Test reverting many documents at once.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            tag.save()
+        revisions = [revision for revision, is_new in Revision.save_revisions(user, doc.tag_models)]
+        for tag in doc.tag_models:
+            tag.title = 'New %s' % (tag.title, )
+            tag.save()
+        doc.tag_models[2].delete()
+        reverted = Revision.revert_many(revisions)
+        self.assertEqual([tag.pk for tag in doc.tag_models], [tag.pk for tag in reverted])
+        for i, tag in enumerate(doc.tag_models):
+            self.assertEqual('Sample Tag %s' % (i, ), SampleTag.objects.get(pk=tag.pk).title)
+
+    def test_revert_many_same_document(self):
+        """
+            Test that revisions of the same document are reverted in order.
+        """
+        user = create_and_save_sample_user()
+        tag = SampleTag(slug='sample-tag', title='Sample Tag')
+        tag.save()
+        first_revision = save_revision_and_check(self, user, tag)
+        tag.title = 'New Sample Tag'
+        tag.save()
+        second_revision = save_revision_and_check(self, user, tag)
+        Revision.revert_many([first_revision, second_revision])
+        self.assertEqual('New Sample Tag', SampleTag.objects.get(pk=tag.pk).title)
+        Revision.revert_many([second_revision, first_revision])
+        self.assertEqual('Sample Tag', SampleTag.objects.get(pk=tag.pk).title)
+
+    def test_revert_user_changes(self):
+        """
+            Test reverting everything a user changed since a given time.
+        """
+        user = create_and_save_sample_user()
+        other_user = create_and_save_sample_user('other')
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            save_revision_and_check(self, user, tag)
+        since = datetime.now()
+        for tag in doc.tag_models[:2]:
+            tag.title = 'New %s' % (tag.title, )
+            tag.save()
+            save_revision_and_check(self, other_user, tag)
+        reverted = Revision.revert_user_changes(other_user, since)
+        self.assertEqual(set([tag.pk for tag in doc.tag_models[:2]]), set([tag.pk for tag in reverted]))
+        for i, tag in enumerate(doc.tag_models):
+            self.assertEqual('Sample Tag %s' % (i, ), SampleTag.objects.get(pk=tag.pk).title)
+
+class ReversionedDocumentTest(RevisionTestCase):
 
     def test_is_versioned(self):
         doc = create_sample_reversioned_document()
@@ -271,3 +550,543 @@ class ReversionedDocumentTest(MongoTestCase):
         doc.slug = 'new-sample-slug'
         doc.save(user=user)
         self.assertEqual(2, doc.revisions.count())
+
+    def test_history(self):
+        user = create_and_save_sample_user()
+        doc = create_sample_reversioned_document()
+        for tag in doc.tag_models:
+            tag.save()
+        revisions = []
+        for i in range(5):
+            doc.title = 'Sample Document Title %s' % (i, )
+            revisions.insert(0, save_revision_and_check(self, user, doc))
+
+        page, cursor = doc.history(limit=2)
+        self.assertEqual([r.pk for r in revisions[:2]], [r.pk for r in page])
+        self.assertFalse(page[0].instance_data)
+        self.assertFalse(page[0].field_hashes)
+        page, cursor = doc.history(limit=2, cursor=cursor)
+        self.assertEqual([r.pk for r in revisions[2:4]], [r.pk for r in page])
+        page, cursor = doc.history(limit=2, cursor=cursor)
+        self.assertEqual([revisions[4].pk], [r.pk for r in page])
+        self.assertEqual(None, cursor)
+
+        self.assertEqual([r.pk for r in revisions], [r.pk for r in doc.iter_history(page_size=2)])
+        page, cursor = doc.history(limit=1, fields=('instance_data', ))
+        self.assertEqual('Sample Document Title 4', page[0].instance_data['title'])
+
+    def test_history_count(self):
+        user = create_and_save_sample_user()
+        doc = create_sample_reversioned_document()
+        for tag in doc.tag_models:
+            tag.save()
+        save_revision_and_check(self, user, doc)
+        key = Revision.history_count_key(ContentType.get_for_class_name(doc._class_name).pk, doc.pk)
+        self.assertEqual(1, doc.history_count(cached=True))
+        self.assertEqual(None, cache.get(key))
+        with override_settings(MONGOREVERSION_COUNT_CACHE_TIMEOUT=300):
+            self.assertEqual(1, doc.history_count(cached=True))
+            self.assertEqual(1, cache.get(key))
+            doc.title = 'New Sample Title'
+            save_revision_and_check(self, user, doc)
+            self.assertEqual(None, cache.get(key))
+            self.assertEqual(2, doc.history_count(cached=True))
+        self.assertEqual(1, doc.history_count(max_count=1))
+
+    def test_as_of(self):
+        user = create_and_save_sample_user()
+        doc = create_sample_reversioned_document()
+        start = datetime(2012, 6, 15, 12)
+        for tag in doc.tag_models:
+            save_revision_and_check(self, user, tag, timestamp=start)
+        rev1 = save_revision_and_check(self, user, doc, timestamp=start + timedelta(hours=1))
+        doc.tag_models[0].title = 'New Sample Tag Title'
+        save_revision_and_check(self, user, doc.tag_models[0], timestamp=start + timedelta(hours=3))
+        doc.title = 'New Sample Title'
+        save_revision_and_check(self, user, doc, timestamp=start + timedelta(hours=4))
+
+        self.assertEqual(None, doc.as_of(rev1.timestamp - timedelta(seconds=1)))
+        instance = doc.as_of(start + timedelta(hours=2))
+        self.assertEqual('Sample Document Title', instance.title)
+        self.assertEqual('Sample Tag 0', instance.tag_models[0].title)
+        instance = doc.as_of(start + timedelta(hours=5))
+        self.assertEqual('New Sample Title', instance.title)
+        self.assertEqual('New Sample Tag Title', instance.tag_models[0].title)
+
+        # the related documents are resolved at the given time, not at the 
+        # time the document revision was saved
+        doc.tag_models[1].title = 'Another Sample Tag Title'
+        save_revision_and_check(self, user, doc.tag_models[1], timestamp=start + timedelta(hours=6))
+        instances = SampleReversionedDocument.as_of_many([doc.pk], start + timedelta(hours=7))
+        self.assertEqual('Another Sample Tag Title', instances[doc.pk].tag_models[1].title)
+
+    def test_as_of_without_related_revisions(self):
+        """
+            Test that related documents without a revision at the given time 
+            fall back to the revision stored with the document revision, then 
+            to the live document.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_reversioned_document()
+        for tag in doc.tag_models:
+            tag.save()
+        Revision.save_revision(user, doc.tag_models[0], timestamp=datetime.now() + timedelta(hours=1))
+        save_revision_and_check(self, user, doc)
+        doc.tag_models[0].title = 'New Sample Tag Title'
+        doc.tag_models[0].save()
+        doc.tag_models[1].title = 'Another Sample Tag Title'
+        doc.tag_models[1].save()
+
+        instance = doc.as_of(datetime.now())
+        self.assertEqual('Sample Tag 0', instance.tag_models[0].title)
+        self.assertEqual('Another Sample Tag Title', instance.tag_models[1].title)
+
+    def test_create_revision_after_save_async(self):
+        user = create_and_save_sample_user()
+        doc = create_sample_reversioned_document(create_revision_after_save=True)
+        doc._meta['revision_async'] = True
+        try:
+            for tag in doc.tag_models:
+                tag.save()
+            doc.save(user=user, revision_comment='sample comment...')
+            background.flush()
+            self.assertEqual(1, doc.revisions.count())
+            self.assertEqual('sample comment...', doc.revisions[0].comment)
+            doc.slug = 'new-sample-slug'
+            doc.save(user=user)
+            background.flush()
+            self.assertEqual(2, doc.revisions.count())
+            self.assertEqual('new-sample-slug', doc.revisions[0].instance.slug)
+        finally:
+            doc._meta['revision_async'] = False
+
+class ThreadedBackendTest(RevisionTestCase):
+
+    def test_submit_and_flush(self):
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        backend = background.ThreadedBackend(max_queue_size=2, batch_size=2)
+        try:
+            for tag in doc.tag_models:
+                tag.save()
+                backend.submit(user, tag, 'sample comment...')
+            backend.flush()
+            for tag in doc.tag_models:
+                self.assertTrue(Revision.latest_revision(tag))
+        finally:
+            backend.shutdown()
+        self.assertEqual([], backend.threads)
+
+    def test_submission_order_and_time(self):
+        """
+            Test that the snapshots of a document are saved in order across 
+            workers, timestamped when they were submitted.
+        """
+        user = create_and_save_sample_user()
+        tag = SampleTag(slug='sample-tag', title='Sample Tag')
+        tag.save()
+        backend = background.ThreadedBackend(batch_size=1, workers=3)
+        submitted = []
+        try:
+            for i in range(5):
+                tag.title = 'Sample Tag Title %s' % (i, )
+                submitted.append(datetime.now())
+                backend.submit(user, SampleTag._from_son(tag.to_mongo()))
+            backend.flush()
+        finally:
+            backend.shutdown()
+        revisions = list(Revision.objects.filter(instance_id=tag.pk).order_by('timestamp', 'id'))
+        self.assertEqual(['Sample Tag Title %s' % (i, ) for i in range(5)], [r.instance_data['title'] for r in revisions])
+        self.assertEqual('Sample Tag Title 4', Revision.latest_revision(tag).instance_data['title'])
+        for revision, timestamp in zip(revisions, submitted):
+            self.assertTrue(revision.timestamp - timestamp < timedelta(seconds=1))
+
+    def test_save_revision_timestamp(self):
+        user = create_and_save_sample_user()
+        tag = SampleTag(slug='sample-tag', title='Sample Tag')
+        timestamp = datetime(2012, 6, 15, 12)
+        revision, is_new = Revision.save_revision(user, tag, timestamp=timestamp)
+        self.assertEqual(timestamp, Revision.objects.get(pk=revision.pk).timestamp)
+
+class ContentTypeCacheTest(RevisionTestCase):
+
+    def test_get_for_class_name(self):
+        self.assertEqual(None, ContentType.get_for_class_name('SampleDocument'))
+        content_type = ContentType.get_for_class_name('SampleDocument', create=True)
+        self.assertTrue(content_type.pk)
+        self.assertTrue(ContentType.get_for_class_name('SampleDocument') is content_type)
+
+    def test_clear_cache(self):
+        content_type = ContentType.get_for_class_name('SampleDocument', create=True)
+        ContentType.objects.filter(pk=content_type.pk).delete()
+        self.assertTrue(ContentType.get_for_class_name('SampleDocument') is content_type)
+        ContentType.clear_cache('SampleDocument')
+        self.assertEqual(None, ContentType.get_for_class_name('SampleDocument'))
+
+    def test_delete_invalidates_cache(self):
+        content_type = ContentType.get_for_class_name('SampleDocument', create=True)
+        content_type.delete()
+        self.assertEqual(None, ContentType.get_for_class_name('SampleDocument'))
+
+class RelatedFieldTypesTest(RevisionTestCase):
+
+    def test_related_field_types(self):
+        field_types = related_field_types(SampleDocument)
+        self.assertEqual({'tag_models': SampleTag}, field_types)
+        self.assertTrue(related_field_types(SampleDocument) is field_types)
+        self.assertEqual({}, related_field_types(SampleTag))
+
+    def test_revision_content_type(self):
+        user = create_and_save_sample_user()
+        tag = SampleTag(slug='sample-tag', title='Sample Tag')
+        revision = save_revision_and_check(self, user, tag)
+        revision = Revision.objects.get(pk=revision.pk)
+        self.assertEqual(revision.instance_type.pk, revision.instance_type_id)
+        self.assertTrue(revision.content_type is ContentType.get_for_class_name(tag._class_name))
+        self.assertEqual(SampleTag, revision.instance_model)
+
+class DeltaStorageTest(RevisionTestCase):
+
+    def test_delta_revisions(self):
+        """
+            Test that only changes are stored, with periodic full snapshots.
+        """
+        user = create_and_save_sample_user()
+        doc = SampleDeltaDocument(slug='sample-doc-slug', title='Sample Document Title', tag_strings=['one', 'two', ])
+        revisions = [save_revision_and_check(self, user, doc)]
+        for i in range(4):
+            doc.title = 'Sample Document Title %s' % (i, )
+            revisions.append(save_revision_and_check(self, user, doc))
+        self.assertEqual([0, 1, 2, 0, 1], [r.delta_depth for r in revisions])
+        self.assertFalse(revisions[0].is_delta)
+        self.assertTrue(revisions[1].is_delta)
+        self.assertEqual({'title': 'Sample Document Title 0'}, revisions[1].instance_data)
+        self.assertFalse(revisions[3].is_delta)
+        self.assertEqual(['one', 'two', ], revisions[3].instance_data['tag_strings'])
+
+    def test_delta_revision_instance(self):
+        """
+            Test reconstructing documents from delta revisions.
+        """
+        user = create_and_save_sample_user()
+        doc = SampleDeltaDocument(slug='sample-doc-slug', title='Sample Document Title', tag_strings=['one', 'two', ])
+        save_revision_and_check(self, user, doc)
+        doc.title = 'New Sample Title'
+        save_revision_and_check(self, user, doc)
+        doc.slug = 'new-sample-slug'
+        save_revision_and_check(self, user, doc)
+        revision = Revision.objects.get(pk=Revision.latest_revision(doc).pk)
+        instance = revision.instance
+        self.assertEqual('New Sample Title', instance.title)
+        self.assertEqual('new-sample-slug', instance.slug)
+        self.assertEqual(['one', 'two', ], instance.tag_strings)
+
+    def test_resolve_deltas(self):
+        """
+            Test replaying the deltas of several revisions at once.
+        """
+        user = create_and_save_sample_user()
+        docs = [SampleDeltaDocument(slug='sample-doc-slug-%s' % (i, ), title='Sample Document Title', tag_strings=['one', ]) for i in range(2)]
+        for doc in docs:
+            save_revision_and_check(self, user, doc)
+            for i in range(2):
+                doc.title = 'Sample Document Title %s' % (i, )
+                save_revision_and_check(self, user, doc)
+        revisions = list(Revision.objects.filter(instance_id__in=[doc.pk for doc in docs]).order_by('timestamp', 'id'))
+        self.assertEqual(4, len([r for r in revisions if r.is_delta]))
+        Revision.resolve_deltas(revisions)
+        for revision in revisions:
+            self.assertTrue(revision._full_instance_data is not None)
+        instances = Revision.materialize(revisions)
+        self.assertEqual(['Sample Document Title', 'Sample Document Title 0', 'Sample Document Title 1'] * 2, [instance.title for instance in instances])
+        self.assertEqual([['one', ]] * 6, [instance.tag_strings for instance in instances])
+
+class StructuredFieldTest(RevisionTestCase):
+
+    def test_structured_fields(self):
+        self.assertEqual(set(['address', 'previous_addresses', 'tags_by_name', 'settings', 'extra']), set(structured_fields(SampleStructuredDocument).keys()))
+        self.assertEqual({}, related_field_types(SampleStructuredDocument))
+        self.assertEqual({}, structured_fields(SampleDocument))
+
+    def test_structural_diff(self):
+        old = {'title': 'a', 'settings': {'colors': {'text': 'black', 'link': 'blue'}, 'sizes': [1, 2]}, 'items': [1]}
+        new = {'title': 'a', 'settings': {'colors': {'text': 'red'}, 'sizes': [1, 3]}, 'items': [1, 2]}
+        changes, removed = structural_diff(old, new)
+        self.assertEqual({'settings__colors__text': 'red', 'settings__sizes__1': 3, 'items': [1, 2]}, changes)
+        self.assertEqual(['settings__colors__link'], removed)
+
+    def test_structured_revision_instance(self):
+        """
+            Test that nested values and the references within them are 
+            restored, versioned related documents as they were.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_structured_document()
+        tag = doc.address.tag
+        tag_revision, is_new = Revision.save_revision(user, tag)
+        revision, is_new = Revision.save_revision(user, doc)
+        self.assertTrue(is_new)
+        self.assertEqual(tag.pk, revision.instance_data['address']['tag'])
+        self.assertEqual(tag_revision.pk, revision.instance_related_revisions['address__tag'])
+        self.assertEqual(tag_revision.pk, revision.instance_related_revisions['tags_by_name__first'])
+        self.assertEqual(tag_revision.pk, revision.instance_related_revisions['address__related'])
+        self.assertEqual('SampleAddress', revision.instance_data['extra']['_cls'])
+        self.assertEqual(doc.extra.tag.pk, revision.instance_data['extra']['tag'])
+
+        tag.title = 'New Sample Tag Title'
+        tag.save()
+        Revision.save_revision(user, tag)
+
+        instance = Revision.objects.get(pk=revision.pk).instance
+        self.assertEqual('Sample City', instance.address.city)
+        self.assertEqual('Sample Tag 0', instance.address.tag.title)
+        self.assertEqual('Sample Tag 0', instance.tags_by_name['first'].title)
+        self.assertEqual('Sample Tag 1', instance.tags_by_name['second'].title)
+        self.assertEqual('Sample Tag 0', instance.address.related.title)
+        self.assertTrue(isinstance(instance.extra, SampleAddress))
+        self.assertEqual('Extra City', instance.extra.city)
+        self.assertEqual('Sample Tag 1', instance.extra.tag.title)
+        self.assertEqual(['0 Old Street', '1 Old Street'], [address.street for address in instance.previous_addresses])
+        self.assertEqual(doc.settings, instance.settings)
+
+        # the new tag revision is a change of the document
+        revision, is_new = Revision.save_revision(user, doc)
+        self.assertTrue(is_new)
+        self.assertEqual(['address', 'tags_by_name'], revision.changed_fields)
+
+    def test_structured_delta(self):
+        """
+            Test that small nested changes are stored and diffed by path.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_structured_document()
+        Revision.save_revision(user, doc)
+        doc.address.city = 'New Sample City'
+        doc.previous_addresses[1].street = '1 New Old Street'
+        doc.settings['colors']['text'] = 'red'
+        del doc.settings['colors']['background']
+        revision, is_new = Revision.save_revision(user, doc)
+        self.assertTrue(revision.is_delta)
+        self.assertEqual({'address__city': 'New Sample City', 'previous_addresses__1__street': '1 New Old Street', 'settings__colors__text': 'red'}, revision.instance_data)
+        self.assertEqual(['settings__colors__background'], revision.unset_fields)
+        self.assertEqual(({'address__city': 'New Sample City', 'previous_addresses__1__street': '1 New Old Street', 'settings__colors__text': 'red'}, ['settings__colors__background']), revision.structural_diff(Revision.objects.filter(instance_id=doc.pk).order_by('timestamp').first()))
+
+        instance = Revision.objects.get(pk=revision.pk).instance
+        self.assertEqual('New Sample City', instance.address.city)
+        self.assertEqual('1 Sample Street', instance.address.street)
+        self.assertEqual('Sample Tag 0', instance.address.tag.title)
+        self.assertEqual(['0 Old Street', '1 New Old Street'], [address.street for address in instance.previous_addresses])
+        self.assertEqual({'colors': {'text': 'red'}, 'sizes': [1, 2, 3]}, instance.settings)
+
+class RetentionTest(RevisionTestCase):
+
+    def sample_revisions(self, now, ages):
+        return [Revision(id=ObjectId(), timestamp=now - age) for age in ages]
+
+    def test_revisions_to_delete_keep_last(self):
+        now = datetime.now()
+        revisions = self.sample_revisions(now, [timedelta(hours=i) for i in range(5)])
+        deleted = retention.revisions_to_delete(revisions, {'keep_last': 2, 'keep_days': 0}, now)
+        self.assertEqual([r.pk for r in revisions[2:]], deleted)
+
+    def test_revisions_to_delete_thinning(self):
+        now = datetime(2012, 6, 15, 12)
+        revisions = self.sample_revisions(now, [timedelta(days=0), timedelta(days=10, hours=1), timedelta(days=10, hours=2), timedelta(days=11), ])
+        deleted = retention.revisions_to_delete(revisions, {'keep_last': 1, 'thin_after_days': 7}, now)
+        self.assertEqual([revisions[2].pk], deleted)
+
+    def test_revisions_to_delete_keeps_delta_bases(self):
+        now = datetime.now()
+        revisions = self.sample_revisions(now, [timedelta(days=i) for i in range(3)])
+        revisions[0].base_revision = revisions[1].pk
+        revisions[1].base_revision = revisions[2].pk
+        self.assertEqual([], retention.revisions_to_delete(revisions, {'keep_last': 1, 'keep_days': 0}, now))
+
+    def test_revisions_to_delete_keeps_referenced(self):
+        now = datetime.now()
+        revisions = self.sample_revisions(now, [timedelta(days=i) for i in range(3)])
+        deleted = retention.revisions_to_delete(revisions, {'keep_last': 1, 'keep_days': 0}, now, referenced=set([revisions[2].pk]))
+        self.assertEqual([revisions[1].pk], deleted)
+
+    def test_prune_revisions(self):
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            tag.save()
+        tag = doc.tag_models[0]
+        tag_revisions = [save_revision_and_check(self, user, tag)]
+        save_revision_and_check(self, user, doc)
+        for i in range(3):
+            tag.title = 'Sample Tag Title %s' % (i, )
+            tag_revisions.append(save_revision_and_check(self, user, tag))
+
+        SampleTag._meta['revision_retention'] = {'keep_last': 1, 'keep_days': 0}
+        try:
+            results = list(retention.prune_revisions(SampleTag, batch_size=2))
+        finally:
+            del SampleTag._meta['revision_retention']
+
+        # the first revision of the first tag is referenced by the document 
+        # revision, the latest one is kept
+        remaining = set(r.pk for r in Revision.objects.filter(instance_id=tag.pk))
+        self.assertEqual(set([tag_revisions[0].pk, tag_revisions[-1].pk]), remaining)
+        self.assertEqual(2, sum(count for last_instance_id, count in results))
+
+    def test_prune_revisions_keeps_referenced_delta_bases(self):
+        """
+            Test that a referenced delta revision keeps the revisions it is 
+            replayed from.
+        """
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            tag.save()
+        tag = doc.tag_models[0]
+        SampleTag._meta['revision_storage'] = 'delta'
+        SampleTag._meta['revision_keyframe_interval'] = 2
+        SampleTag._meta['revision_retention'] = {'keep_last': 1, 'keep_days': 0}
+        try:
+            tag_revisions = [save_revision_and_check(self, user, tag)]
+            tag.title = 'Sample Tag Title 0'
+            tag_revisions.append(save_revision_and_check(self, user, tag))
+            save_revision_and_check(self, user, doc)
+            for i in range(1, 3):
+                tag.title = 'Sample Tag Title %s' % (i, )
+                tag_revisions.append(save_revision_and_check(self, user, tag))
+            self.assertEqual([0, 1, 0, 1], [r.delta_depth for r in tag_revisions])
+            list(retention.prune_revisions(SampleTag))
+        finally:
+            del SampleTag._meta['revision_storage']
+            del SampleTag._meta['revision_keyframe_interval']
+            del SampleTag._meta['revision_retention']
+
+        # the delta referenced by the document revision keeps its base
+        remaining = set(r.pk for r in Revision.objects.filter(instance_id=tag.pk))
+        self.assertEqual(set(r.pk for r in tag_revisions), remaining)
+        self.assertEqual('Sample Tag Title 0', Revision.objects.get(pk=tag_revisions[1].pk).instance.title)
+
+class BackfillTest(RevisionTestCase):
+
+    def test_create_initial_revisions(self):
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            tag.save()
+        save_revision_and_check(self, user, doc.tag_models[1])
+
+        results = list(backfill.create_initial_revisions(SampleTag, user, batch_size=2))
+        self.assertEqual([1, 1], [count for last_id, count in results])
+        self.assertEqual(doc.tag_models[-1].pk, results[-1][0])
+        for tag in doc.tag_models:
+            self.assertEqual(1, Revision.objects.filter(instance_id=tag.pk).count())
+
+        # rerunning creates nothing
+        self.assertEqual([0, 0], [count for last_id, count in backfill.create_initial_revisions(SampleTag, user, batch_size=2)])
+
+    def test_split_id_range(self):
+        tags = [SampleTag(slug='sample-tag-%s' % (i, ), title='Sample Tag %s' % (i, )) for i in range(6)]
+        for tag in tags:
+            tag.save()
+        ranges = backfill.split_id_range(SampleTag, 3)
+        self.assertEqual([(None, tags[2].pk), (tags[1].pk, tags[4].pk), (tags[3].pk, None)], ranges)
+
+class MetricsTest(RevisionTestCase):
+
+    def test_metrics_listener(self):
+        events = []
+        def listener(operation, phase, duration, commands):
+            events.append((operation, phase))
+            self.assertTrue(duration >= 0)
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            save_revision_and_check(self, user, tag)
+        add_metrics_listener(listener)
+        try:
+            revision = save_revision_and_check(self, user, doc)
+            revision.instance
+            revision.revert()
+        finally:
+            remove_metrics_listener(listener)
+        for event in [('save_revision', 'content_types'), ('save_revision', 'related_revisions'), ('save_revision', 'latest_revisions'), ('save_revision', 'insert'), ('materialize', 'related_revisions'), ('revert', 'live_documents'), ]:
+            self.assertTrue(event in events, event)
+
+        # nothing is reported once the listener is removed
+        del events[:]
+        doc.title = 'New Sample Title'
+        save_revision_and_check(self, user, doc)
+        self.assertEqual([], events)
+
+class RevisionUserTest(RevisionTestCase):
+
+    def test_user(self):
+        user = create_and_save_sample_user()
+        tag = SampleTag(slug='sample-tag', title='Sample Tag')
+        revision = Revision.objects.get(pk=save_revision_and_check(self, user, tag).pk)
+        self.assertEqual(user, revision.user)
+        self.assertTrue(revision.user is revision.user)
+
+    def test_mongo_user(self):
+        user = create_and_save_sample_mongo_user()
+        tag = SampleTag(slug='sample-tag', title='Sample Tag')
+        revision = save_revision_and_check(self, user, tag)
+        with override_settings(MONGOREVERSION_USER_DOCUMENT='MongoUser'):
+            self.assertEqual(user, Revision.objects.get(pk=revision.pk).user)
+        self.assertEqual(None, Revision.objects.get(pk=revision.pk).user)
+
+    def test_resolve_users(self):
+        users = [create_and_save_sample_user(i) for i in range(3)]
+        doc = create_sample_revisioned_document()
+        for tag, user in zip(doc.tag_models, users):
+            save_revision_and_check(self, user, tag)
+        revisions = list(Revision.objects.all())
+        Revision.resolve_users(revisions)
+        self.assertEqual(set(users), set(revision._user_cache for revision in revisions))
+
+    def test_user_loader_setting(self):
+        user = create_and_save_sample_user()
+        tag = SampleTag(slug='sample-tag', title='Sample Tag')
+        revision = save_revision_and_check(self, user, tag)
+        self.assertEqual(user, Revision.objects.get(pk=revision.pk).user)
+        with override_settings(MONGOREVERSION_USER_LOADER='mongoreversion.tests.load_sample_users'):
+            self.assertEqual('user %s' % (user.pk, ), Revision.objects.get(pk=revision.pk).user)
+        self.assertEqual(user, Revision.objects.get(pk=revision.pk).user)
+
+class CompressionTest(RevisionTestCase):
+
+    def test_compressed_revisions(self):
+        user = create_and_save_sample_user()
+        doc = SampleCompressedDocument(slug='sample-doc-slug', title='Sample Document Title', body='Sample body. ' * 1000)
+        revision = save_revision_and_check(self, user, doc)
+        self.assertEqual({}, Revision._get_collection().find_one({'_id': revision.pk})['instance_data'])
+        stored = Revision.objects.get(pk=revision.pk)
+        self.assertEqual('zlib', stored.compression)
+        # loading leaves the payload compressed until it is read
+        self.assertEqual({}, stored._data['instance_data'])
+        self.assertEqual(doc.body, stored.instance_data['body'])
+        self.assertEqual(doc.body, Revision.objects.get(pk=revision.pk).full_instance_data['body'])
+        self.assertTrue(len(stored.instance_data_compressed) < len(doc.body))
+        self.assertEqual(doc.body, stored.instance.body)
+        page, cursor = Revision.history(doc, fields=('instance_data', ))
+        self.assertEqual(doc.body, page[0].instance_data['body'])
+
+        revision, is_new = Revision.save_revision(user, doc)
+        self.assertFalse(is_new)
+        doc.title = 'New Sample Title'
+        revision, is_new = Revision.save_revision(user, doc)
+        self.assertTrue(is_new)
+        self.assertEqual(['title', ], revision.changed_fields)
+        self.assertEqual({'title': 'New Sample Title'}, Revision.objects.get(pk=revision.pk).diff(stored))
+
+    def test_compress_existing_revisions(self):
+        user = create_and_save_sample_user()
+        doc = create_sample_revisioned_document()
+        for tag in doc.tag_models:
+            save_revision_and_check(self, user, tag)
+        results = list(compression.compress_existing_revisions(SampleTag, 'zlib', batch_size=2))
+        self.assertEqual([2, 1], [count for last_id, count in results])
+        for tag in doc.tag_models:
+            revision = Revision.latest_revision(tag)
+            self.assertEqual('zlib', revision.compression)
+            self.assertEqual(tag.title, revision.instance.title)
+        self.assertEqual([], list(compression.compress_existing_revisions(SampleTag, 'zlib')))
@@ -12,6 +12,8 @@ setup(
     url='http://github.com/snormore/django-mongoreversion/',
     packages=[
         'mongoreversion',
+        'mongoreversion.management',
+        'mongoreversion.management.commands',
     ],
     install_requires=[
         'django', 